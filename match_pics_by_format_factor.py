@@ -1,13 +1,39 @@
 #!/usr/bin/python
 import os
+import json
+import math
 import time
 import shutil
 import argparse
+import multiprocessing
 
 from PIL import Image
 
+# NumPy is only needed for screening ('-s').
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 PICTURE_EXTENSIONS = (".jpg", ".jpeg", ".tiff", ".png")
 
+# Tiled pyramid defaults. Must match the reader in 'panodpf_server.py'.
+PYRAMID_EXTENSION = ".pyramid"
+PYRAMID_INDEX_FILE_NAME = "index.json"
+PYRAMID_TILE_EXTENSION = "jpg"
+PYRAMID_TILE_SIZE_DEFAULT = 512
+PYRAMID_TILE_QUALITY = 90
+PYRAMID_VERSION = 1
+
+# Screening defaults. The index file name must match the one in 'panodpf_client.py'.
+SCREENING_INDEX_FILE_NAME = "panodpf_screening.json"
+SCREENING_VERSION = 1
+SCREENING_THUMBNAIL_HEIGHT = 256
+SCREENING_HASH_SIZE = 8
+SCREENING_BATCH_SIZE = 16
+DUPLICATE_DISTANCE_DEFAULT = 6
+MIN_SHARPNESS_DEFAULT = 100.0
+
 def matches_ff_rules(ff, le, ge):
     if ge > 0 and le > 0:
         return ge <= ff <= le
@@ -29,11 +55,193 @@ def copy_file(full_file_path, final_folder, w, h):
         print "    Could not copy image '{0}' to folder '{1}': {2}".format(full_file_path, final_folder, e)
 
 
-def match_pics_by_form_factor(folder, recursive, le, ge, copy_to_folder, resize_to_height):
+def build_pyramid_path(image_path, final_folder):
+    imgname = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(final_folder, imgname + PYRAMID_EXTENSION)
+
+
+def save_pyramid_level(level_image_object, level, level_folder, tile_size):
+    w, h = level_image_object.size
+    columns = int(math.ceil(float(w)/tile_size))
+    rows = int(math.ceil(float(h)/tile_size))
+
+    for column in xrange(columns):
+        for row in xrange(rows):
+            box = (column*tile_size, row*tile_size, min(w, (column + 1)*tile_size), min(h, (row + 1)*tile_size))
+            tile_path = os.path.join(level_folder, "{0}_{1}.{2}".format(column, row, PYRAMID_TILE_EXTENSION))
+            level_image_object.crop(box).save(tile_path, quality=PYRAMID_TILE_QUALITY)
+
+    return {"level": level, "width": w, "height": h, "columns": columns, "rows": rows}
+
+
+def build_pyramid(image_object, pyramid_path, tile_size):
+    """ Saves the image as JPEG tiles at halving resolutions until a level fits in a single tile. """
+    level_image_object = image_object if image_object.mode == 'RGB' else image_object.convert('RGB')
+    level = 0
+    levels = []
+
+    while True:
+        level_folder = os.path.join(pyramid_path, str(level))
+        if not os.path.exists(level_folder):
+            os.makedirs(level_folder)
+
+        levels.append(save_pyramid_level(level_image_object, level, level_folder, tile_size))
+
+        w, h = level_image_object.size
+        if w <= tile_size and h <= tile_size:
+            break
+
+        level_image_object = level_image_object.resize((max(1, w/2), max(1, h/2)), resample=Image.LANCZOS)
+        level += 1
+
+    w, h = image_object.size
+    index = {"version": PYRAMID_VERSION, "width": w, "height": h, "tile_size": tile_size, "tile_extension": PYRAMID_TILE_EXTENSION, "levels": levels}
+    with open(os.path.join(pyramid_path, PYRAMID_INDEX_FILE_NAME), "w") as fd:
+        json.dump(index, fd)
+
+    return len(levels)
+
+
+def hamming_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count("1")
+
+
+class BKTree(object):
+    """ Burkhard-Keller tree of perceptual hashes so near duplicates are found without comparing all pairs. """
+
+    def __init__(self):
+        # Each node is [hash, value, {distance: child node}].
+        self.root = None
+
+    def add(self, hash_value, value):
+        if self.root is None:
+            self.root = [hash_value, value, {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming_distance(hash_value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_value, value, {}]
+                return
+            node = child
+
+    def find(self, hash_value, max_distance):
+        """ Returns (distance, value) of the closest hash within 'max_distance' or None. """
+        best = None
+        pending_nodes = [self.root] if self.root else []
+        while pending_nodes:
+            node = pending_nodes.pop()
+            distance = hamming_distance(hash_value, node[0])
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, node[1])
+
+            # The triangle inequality tells us which children can hold hashes within 'max_distance'.
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    pending_nodes.append(child)
+
+        return best
+
+
+def load_thumbnail(image_path):
+    image_object = Image.open(image_path)
+    w, h = image_object.size
+
+    # Let the JPEG decoder do the downscaling, screening only needs a small grayscale thumbnail.
+    thumbnail_width = max(1, int(float(w * SCREENING_THUMBNAIL_HEIGHT)/h))
+    image_object.draft('L', (thumbnail_width, SCREENING_THUMBNAIL_HEIGHT))
+    thumbnail = image_object.convert('L').resize((thumbnail_width, SCREENING_THUMBNAIL_HEIGHT), resample=Image.BILINEAR)
+    return thumbnail, w, h
+
+
+def compute_dhash(thumbnail):
+    pixels = numpy.asarray(thumbnail.resize((SCREENING_HASH_SIZE + 1, SCREENING_HASH_SIZE), resample=Image.BILINEAR), dtype=numpy.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return sum(1 << int(i) for i in numpy.flatnonzero(bits))
+
+
+def compute_sharpness(thumbnail):
+    # Variance of the Laplacian. Blurred pictures have few edges and thus a low variance.
+    pixels = numpy.asarray(thumbnail, dtype=numpy.float32)
+    laplacian = pixels[1:-1, :-2] + pixels[1:-1, 2:] + pixels[:-2, 1:-1] + pixels[2:, 1:-1] - 4 * pixels[1:-1, 1:-1]
+    return float(laplacian.var())
+
+
+def screen_picture(image_path):
+    try:
+        thumbnail, w, h = load_thumbnail(image_path)
+        return image_path, w, h, compute_dhash(thumbnail), compute_sharpness(thumbnail)
+    except (IOError, ValueError) as e:
+        print "    Could not screen image '{0}': {1}".format(image_path, e)
+        return image_path, None, None, None, None
+
+
+def find_pictures(folder, recursive):
+    for current_folder, folder_list, file_list in os.walk(folder):
+        # Never descend into pyramids we built before, they only contain tiles.
+        folder_list[:] = [f for f in folder_list if not f.endswith(PYRAMID_EXTENSION)]
+
+        for f in file_list:
+            if f.lower().endswith(PICTURE_EXTENSIONS):
+                yield os.path.join(current_folder, f)
+
+        if not recursive:
+            break
+
+
+def screen_pics(folder, recursive, duplicate_distance, min_sharpness, processes=None):
+    """ Scores all pictures and saves dimensions, perceptual hashes, sharpness and duplicate clusters in an index file. """
+    start = time.time()
+
+    # Decode the thumbnails in batches across all cores.
+    pool = multiprocessing.Pool(processes)
+    screened_pictures = [screened for screened in pool.imap_unordered(screen_picture, find_pictures(folder, recursive), SCREENING_BATCH_SIZE) if screened[1]]
+    pool.close()
+    pool.join()
+
+    # Visit sharp pictures first, then the biggest and sharpest, so they become the representatives of their duplicate
+    # clusters. A blurry representative would get its whole cluster skipped when both duplicates and blurry pictures are.
+    screened_pictures.sort(key=lambda screened: (screened[4] >= min_sharpness, screened[1] * screened[2], screened[4]), reverse=True)
+
+    representatives = BKTree()
+    pictures = {}
+    nduplicates = nblurry = 0
+    for image_path, w, h, dhash, sharpness in screened_pictures:
+        relative_path = os.path.relpath(image_path, folder).replace(os.sep, "/")
+        picture = {"width": w, "height": h, "dhash": "{0:016x}".format(dhash), "sharpness": round(sharpness, 1),
+                   "blurry": sharpness < min_sharpness, "duplicate_of": None}
+
+        closest = representatives.find(dhash, duplicate_distance)
+        if closest:
+            picture['duplicate_of'] = closest[1]
+            nduplicates += 1
+            print "'{0}' is a near duplicate of '{1}' (distance {2}).".format(relative_path, closest[1], closest[0])
+        else:
+            representatives.add(dhash, relative_path)
+
+        if picture['blurry']:
+            nblurry += 1
+            print "'{0}' is blurry (sharpness {1:.1f} < {2}).".format(relative_path, sharpness, min_sharpness)
+
+        pictures[relative_path] = picture
+
+    index = {"version": SCREENING_VERSION, "duplicate_distance": duplicate_distance, "min_sharpness": min_sharpness, "pictures": pictures}
+    with open(os.path.join(folder, SCREENING_INDEX_FILE_NAME), "w") as fd:
+        json.dump(index, fd, indent=1, sort_keys=True)
+
+    return len(screened_pictures), nduplicates, nblurry, int(time.time() - start)
+
+
+def match_pics_by_form_factor(folder, recursive, le, ge, copy_to_folder, resize_to_height, pyramid_folder=None, tile_size=PYRAMID_TILE_SIZE_DEFAULT):
     total_pictures = 0
     matched_pictures = 0
     start = time.time()
     for current_folder, folder_list, file_list in os.walk(folder):
+        # Never descend into pyramids we built before, they only contain tiles.
+        folder_list[:] = [f for f in folder_list if not f.endswith(PYRAMID_EXTENSION)]
+
         for f in file_list:
             # Check that it's a picture.
             if f.lower().endswith(PICTURE_EXTENSIONS):
@@ -42,7 +250,8 @@ def match_pics_by_form_factor(folder, recursive, le, ge, copy_to_folder, resize_
                 image_object = Image.open(image_path)
                 w, h = image_object.size
                 ff = float(w)/h
-                if matches_ff_rules(ff, le, ge):
+                # When building pyramids without form factor rules every picture matches.
+                if matches_ff_rules(ff, le, ge) or (pyramid_folder and not le and not ge):
                     print "'{0}': {1:.3}".format(image_path, ff)
                     matched_pictures += 1
                     if copy_to_folder:
@@ -62,6 +271,13 @@ def match_pics_by_form_factor(folder, recursive, le, ge, copy_to_folder, resize_
                             print "    Saving resized image to path '{0}' ...".format(final_image_path)
                             resized_image_object.save(final_image_path)
 
+                    if pyramid_folder:
+                        final_folder = os.path.join(pyramid_folder, current_folder[len(folder):].lstrip(os.sep))
+                        pyramid_path = build_pyramid_path(image_path, final_folder)
+                        print "    Building tiled pyramid '{0}' ...".format(pyramid_path)
+                        nlevels = build_pyramid(image_object, pyramid_path, tile_size)
+                        print "    Built tiled pyramid with {0} levels.".format(nlevels)
+
         if not recursive:
             break
 
@@ -69,20 +285,40 @@ def match_pics_by_form_factor(folder, recursive, le, ge, copy_to_folder, resize_
 
 
 def main():
-    parser = argparse.ArgumentParser(description='Filter panoramas by form factor.', epilog="At least one of '-l' or '-g' should be specified.")
+    parser = argparse.ArgumentParser(description='Filter panoramas by form factor.', epilog="At least one of '-l', '-g', '-p' or '-s' should be specified. "
+                                                                                              "With '-p' alone all pictures are converted.")
     parser.add_argument("folder", type=str, help="Folder to start looking for pictures.")
     parser.add_argument("-r", "--recursive", action="store_true", default=True, help="Recurse into subfolders.")
     parser.add_argument("-l", "--less-than-or-equal", "--le", type=float, default=0, help="Form factor should be less than or equal to this valuse.")
     parser.add_argument("-g", "--greater-than-or-equal", "--ge", type=float, default=0, help="Form factor should be more than or equal to this valuse.")
     parser.add_argument("-c", "--copy-to-folder", type=str, help="Copy matched pictures to the specified folder maintaining the original folder structure.")
     parser.add_argument("-e", "--resize-to-height", type=int, help="Resize matched pictures to the specified height if current height is bigger than the specified height.")
+    parser.add_argument("-p", "--pyramid-folder", type=str, help="Convert matched pictures to tiled multi-resolution pyramids in the specified folder maintaining the original folder structure.")
+    parser.add_argument("-t", "--tile-size", type=int, default=PYRAMID_TILE_SIZE_DEFAULT, help="Pyramid tile size in pixels.")
+    parser.add_argument("-s", "--screen", action="store_true", default=False, help="Screen all pictures for near duplicates and blur and save the results to "
+                                                                                     "'{0}' in the folder. Requires NumPy.".format(SCREENING_INDEX_FILE_NAME))
+    parser.add_argument("-d", "--duplicate-distance", type=int, default=DUPLICATE_DISTANCE_DEFAULT, help="Maximum perceptual hash distance (out of 64 bits) of near duplicates.")
+    parser.add_argument("-m", "--min-sharpness", type=float, default=MIN_SHARPNESS_DEFAULT, help="Pictures with a sharpness score below this value are flagged as blurry.")
+    parser.add_argument("-j", "--processes", type=int, help="Number of screening processes. Defaults to the number of CPUs.")
     args = parser.parse_args()
 
-    if args.less_than_or_equal == 0 and args.greater_than_or_equal == 0:
+    if args.screen:
+        if numpy is None:
+            print "Screening requires NumPy. Please install it first."
+            return 1
+
+        total, duplicates, blurry, total_time = screen_pics(args.folder, args.recursive, args.duplicate_distance, args.min_sharpness, args.processes)
+        print "Total pictures: {0}  Near duplicates: {1}  Blurry pictures: {2}  Total time: {3} s".format(total, duplicates, blurry, total_time)
+        return 0
+
+    if args.less_than_or_equal == 0 and args.greater_than_or_equal == 0 and not args.pyramid_folder:
         parser.print_help()
         return 1
 
-    total, matched, total_time = match_pics_by_form_factor(args.folder, args.recursive, args.less_than_or_equal, args.greater_than_or_equal, args.copy_to_folder, args.resize_to_height)
+    total, matched, total_time = match_pics_by_form_factor(args.folder, args.recursive, args.less_than_or_equal, args.greater_than_or_equal, args.copy_to_folder, args.resize_to_height,
+                                                           args.pyramid_folder, args.tile_size)
     print "Total pictures: {0}  {1} pictures: {2}  Total time: {3} s".format(total, "Copied" if args.copy_to_folder else "Matched", matched, total_time)
 
-main()
+# Guard the entry point so screening worker processes never run it again.
+if __name__ == "__main__":
+    main()
@@ -9,10 +9,14 @@ Written by Remus Koos.
 import os
 import json
 import time
+import zlib
+import base64
+import select
 import socket
 import struct
 import random
 import argparse
+import panodpf_wire
 
 from Queue import Queue
 
@@ -21,6 +25,7 @@ plugin_mode = True
 # This try/except for imports helps us to figure out if we are in plugin or standalone mode.
 try:
     import xbmc
+    import xbmcgui
     import xbmcvfs
     import xbmcaddon
 
@@ -36,11 +41,30 @@ except ImportError:
 ANNOTATION_FONT_FILE_DEFAULT = "LiberationSans-Bold.ttf"
 
 ALLOWED_EXTENSIONS = (".jpg", ".png", ".tiff", ".gif")
+# Tiled pyramids built by 'match_pics_by_format_factor.py' are folders with an index file.
+PYRAMID_EXTENSION = ".pyramid"
+PYRAMID_INDEX_FILE_NAME = "index.json"
+# Screening index written by 'match_pics_by_format_factor.py -s' in the pano folder.
+SCREENING_INDEX_FILE_NAME = "panodpf_screening.json"
+SCREENING_VERSION = 1
 MAX_REQUEST_ID = 100000
 PLAYLIST_FILE_NAME = "/tmp/PANODPF.playlist"
 DISPLAY_SCHEDULE_TYPE_MAPPING = {0: 'Random', 1: 'Flat', 2: 'LR', 3: 'RL', 4: 'V', 5: 'ReverseV', 6: 'Shuffle'}
 DISPLAY_SCHEDULES = ('Flat', 'LR', 'RL', 'V', 'ReverseV', 'Shuffle')
 
+# Slideshow clock settings.
+CLOCK_MONOTONIC = 1
+PREPARE_TIME_SAFETY_FACTOR = 1.5
+PREPARE_TIME_SMOOTHING = 0.3
+DEADLINE_TOLERANCE = 0.5
+SLIDESHOW_STATS_WINDOW_ID = 10000
+
+# Wall 1 uses the main settings. Additional walls use settings prefixed with 'wall<N>_'.
+MAX_WALLS = 3
+# Servers reply to 'finish_pano' with this result while they still render the full quality slice.
+FINISH_PANO_PENDING = "Pending"
+FINISH_PANO_POLL_INTERVAL = 0.5
+
 DELAY_INCREMENT_MAPPING = {0: 100, 1: 200, 2: 300, 3: 400, 4: 500, 5: 600, 6: 700, 7: 800, 8: 900, 9: 1000, 10: 1500, 11: 2000, 12: 2500, 13: 3000}
 
 
@@ -97,6 +121,97 @@ class LRURandomInt(object):
         return new_random_int
 
 
+def build_monotonic_time():
+    """ Returns a monotonic clock function. Python 2 has no 'time.monotonic()' so we call 'clock_gettime(...)' directly. """
+    try:
+        import ctypes
+        import ctypes.util
+
+        class Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+    except (ImportError, OSError, AttributeError) as e:
+        log("Monotonic clock is not available ({0}). Falling back to wall clock time.".format(e))
+        return time.time
+
+    def monotonic_time():
+        ts = Timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            return time.time()
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    return monotonic_time
+
+
+class SlideshowClock(object):
+    """ Keeps slide changes on fixed deadlines and starts preparing each slide early enough to hit its deadline. """
+
+    def __init__(self, period, clock=None):
+        self.period = period
+        self.clock = clock or monotonic_time
+        # The first slide is due as soon as it is ready, so the library scan and the first preparation are not late.
+        self.deadline = None
+        # Exponential moving average of how long the servers take to process a pano.
+        self.prepare_time = 0.0
+        self.nprepared = 0
+        self.nslides = 0
+        self.nmissed = 0
+        self.total_lateness = 0.0
+
+    def set_period(self, period):
+        self.period = period
+
+    def _sleep_until(self, wake_up_time):
+        sleep_time = wake_up_time - self.clock()
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+
+    def wait_to_prepare(self):
+        if self.deadline is not None:
+            self._sleep_until(self.deadline - self.prepare_time * PREPARE_TIME_SAFETY_FACTOR)
+
+    def record_prepare_time(self, measured):
+        self.prepare_time = measured if not self.nprepared else (1 - PREPARE_TIME_SMOOTHING) * self.prepare_time + PREPARE_TIME_SMOOTHING * measured
+        self.nprepared += 1
+        log("Preparing slide took {0:.2f} s (average {1:.2f} s).".format(measured, self.prepare_time))
+
+    def wait_for_deadline(self):
+        if self.deadline is None:
+            self.deadline = self.clock()
+        self._sleep_until(self.deadline)
+
+    def slide_due(self):
+        """ Call right after 'wait_for_deadline()', before sending the display request, so the servers' own schedule
+        delays do not count as lateness. """
+        now = self.clock()
+        lateness = now - self.deadline
+        self.nslides += 1
+
+        if lateness > DEADLINE_TOLERANCE:
+            self.nmissed += 1
+            self.total_lateness += lateness
+            log("Missed slide deadline by {0:.2f} s ({1} of {2} deadlines missed).".format(lateness, self.nmissed, self.nslides), level=xbmc.LOGWARNING)
+
+        # Stay on the fixed grid of deadlines unless we are more than a whole period late, in which case we start over
+        # from now instead of rushing through several slides to catch up.
+        self.deadline += self.period
+        if self.deadline < now:
+            self.deadline = now + self.period
+
+        self.export_stats()
+
+    def export_stats(self):
+        # Export the statistics as home window properties so skins and other addons can show them.
+        home_window = xbmcgui.Window(SLIDESHOW_STATS_WINDOW_ID)
+        home_window.setProperty('PanoDPF.Slides', str(self.nslides))
+        home_window.setProperty('PanoDPF.MissedDeadlines', str(self.nmissed))
+        home_window.setProperty('PanoDPF.AverageLateness', "{0:.2f}".format(self.total_lateness / self.nmissed if self.nmissed else 0.0))
+        home_window.setProperty('PanoDPF.PrepareTime', "{0:.2f}".format(self.prepare_time))
+
+
+monotonic_time = getattr(time, 'monotonic', None) or build_monotonic_time()
 display_schedule_random_int = LRURandomInt(len(DISPLAY_SCHEDULES))
 playlist_random_int = None
 
@@ -106,6 +221,9 @@ def display_notification(message, time_in_s=10):
 
 
 def xbmc_file_exists(xbmc_file_name):
+    # A pyramid exists if its index file exists.
+    if xbmc_file_name.endswith(PYRAMID_EXTENSION):
+        xbmc_file_name = os.path.join(xbmc_file_name, PYRAMID_INDEX_FILE_NAME)
     return xbmcvfs.exists(xbmc.translatePath(xbmc_file_name))
 
 
@@ -185,18 +303,70 @@ def xbmcvfs_walk(pano_folder, recurse_into_subfolders=True):
             break
 
 
+def load_screening_index(pano_folder):
+    screening_index_path = os.path.join(pano_folder, SCREENING_INDEX_FILE_NAME)
+    if not xbmc_file_exists(screening_index_path):
+        return {}
+
+    screening_index_file = xbmcvfs.File(xbmc.translatePath(screening_index_path))
+    try:
+        screening_index = json.loads(screening_index_file.read())
+    except ValueError as e:
+        log("Could not decode screening index '{0}': {1}".format(screening_index_path, e), level=xbmc.LOGWARNING)
+        return {}
+    finally:
+        screening_index_file.close()
+
+    if screening_index.get('version') != SCREENING_VERSION:
+        log("Unsupported screening index version '{0}'. Ignoring '{1}'.".format(screening_index.get('version'), screening_index_path), level=xbmc.LOGWARNING)
+        return {}
+
+    log("Loaded screening index '{0}' with {1} pictures.".format(screening_index_path, len(screening_index.get('pictures', {}))))
+    return screening_index.get('pictures', {})
+
+
+def is_screened_out(screened_pictures, relative_path, skip_duplicates, skip_blurry):
+    try:
+        picture = screened_pictures.get(relative_path.decode("utf-8"))
+    except UnicodeDecodeError:
+        return False
+
+    if not picture:
+        return False
+
+    return (skip_duplicates and picture.get('duplicate_of')) or (skip_blurry and picture.get('blurry'))
+
+
 def generate_playlist(pano_folder, recurse_into_subfolders, playlist_file_name=PLAYLIST_FILE_NAME):
     nitems = 0
+    nskipped = 0
+
+    # Skip near duplicates and blurry pictures flagged by the screening tool without having to decode them.
+    screened_pictures = load_screening_index(pano_folder)
+    skip_duplicates = __addon__.getSetting('skip_duplicates').lower() == "true"
+    skip_blurry = __addon__.getSetting('skip_blurry').lower() == "true"
 
     with open(playlist_file_name, "w+b") as fd:
         for folder, folder_list, file_list in xbmcvfs_walk(pano_folder, recurse_into_subfolders):
+            # Pyramids are playlist items, not folders to recurse into. Prune them in place like 'os.walk(...)' allows.
+            pyramid_list = [f for f in folder_list if f.endswith(PYRAMID_EXTENSION)]
+            folder_list[:] = [f for f in folder_list if not f.endswith(PYRAMID_EXTENSION)]
+            for pyramid in pyramid_list:
+                fd.write(os.path.join(folder, pyramid) + os.linesep)
+                nitems += 1
+
             for file in file_list:
                 if file.lower().endswith(ALLOWED_EXTENSIONS):
+                    full_path = os.path.join(folder, file)
+                    if screened_pictures and is_screened_out(screened_pictures, full_path[len(pano_folder):].lstrip("/"), skip_duplicates, skip_blurry):
+                        nskipped += 1
+                        continue
+
                     # For each picture file we construct and write the full path.
-                    fd.write(os.path.join(folder, file) + os.linesep)
+                    fd.write(full_path + os.linesep)
                     nitems += 1
 
-    log("Generated playlist '{0}' with {1} items.".format(playlist_file_name, nitems))
+    log("Generated playlist '{0}' with {1} items ({2} screened out).".format(playlist_file_name, nitems, nskipped))
     return playlist_file_name, nitems
 
 
@@ -255,20 +425,67 @@ def pano_paths(pano_folder, recurse_into_subfolders=True, randomize=True):
             yield pano_file_path
 
 
+def reassemble_reply_payload(reply, fragments_per_display):
+    """ Collects payload fragments and returns the decoded payload once all fragments from a display arrived. """
+    fragments = fragments_per_display.setdefault(reply.get('current_display'), {})
+    fragments[reply['fragment']] = reply.get('payload', "")
+    if len(fragments) < reply['fragments']:
+        return None
+
+    return json.loads(zlib.decompress(base64.b64decode("".join(fragments[i] for i in xrange(reply['fragments'])))))
+
+
+def log_profile_report(current_display, report):
+    if not report:
+        log("Display {0} has no profile report yet.".format(current_display))
+        return
+
+    log("Profile report for display {0} (max RSS before/after: {1} KB):".format(current_display, report.get('max_rss_kb')))
+    log("    {0:>8} {1:>10} {2:>10}  {3}".format("calls", "tottime", "cumtime", "function"))
+    for function, ncalls, tottime, cumtime in report.get('functions', []):
+        log("    {0:>8} {1:>10} {2:>10}  {3}".format(ncalls, tottime, cumtime, function))
+
+    if report.get('allocations') is None:
+        log("    No allocation sites (tracemalloc is not available on the server).")
+        return
+
+    log("    {0:>8} {1:>10}  {2}".format("KB", "blocks", "allocation site"))
+    for location, size_kb, count in report['allocations']:
+        log("    {0:>8} {1:>10}  {2}".format(size_kb, count, location))
+
+
+def encode_request(request, binary=False):
+    """ Returns the list of datagrams to send for a request. """
+    if binary:
+        return panodpf_wire.build_datagrams(request, request['id'])
+
+    return [json.dumps(request)]
+
+
+def decode_reply(datagram, server, wire_reassembler):
+    """ Returns the decoded reply or None if it could not be decoded or we still wait for some of its fragments. """
+    try:
+        if panodpf_wire.is_wire_datagram(datagram):
+            return wire_reassembler.feed(datagram, server)
+        return json.loads(datagram)
+    except (TypeError, ValueError) as e:
+        log("Could not decode reply '{0}' from {1}: {2}".format(repr(datagram[:64]), server, e))
+        return None
+
+
 def received_all_replies(sock, nreplies_expected):
     nreplies = 0
     reply_set = set()
+    fragments_per_display = {}
+    wire_reassembler = panodpf_wire.Reassembler()
 
     # Look for responses from all recipients.
     while True:
         log("Waiting for replies from servers. Expecting {0} ACKs ...".format(nreplies_expected))
         reply = None
         try:
-            json_reply, server = sock.recvfrom(1024)
-            try:
-                reply = json.loads(json_reply)
-            except (TypeError, ValueError) as e:
-                log("Could not decode JSON reply '{0}': {1}".format(json_reply, e))
+            datagram, server = sock.recvfrom(panodpf_wire.WIRE_MAX_DATAGRAM_SIZE)
+            reply = decode_reply(datagram, server, wire_reassembler)
         except socket.timeout:
             log("Timed out. Assuming no more replies (got {0} total).".format(nreplies))
             break
@@ -276,6 +493,15 @@ def received_all_replies(sock, nreplies_expected):
             if reply:
                 log("Received '{0}' from {1}".format(reply, server))
                 current_display = reply.get('current_display')
+                # A display only counts as replied once all fragments of a fragmented reply arrived.
+                if 'fragments' in reply and current_display not in reply_set:
+                    payload = reassemble_reply_payload(reply, fragments_per_display)
+                    if payload is None:
+                        continue
+                    log_profile_report(current_display, payload)
+                elif 'payload' in reply and current_display not in reply_set:
+                    log_profile_report(current_display, reply['payload'])
+
                 if current_display not in reply_set:
                     reply_set.add(current_display)
 
@@ -290,19 +516,20 @@ def received_all_replies(sock, nreplies_expected):
     return nreplies != 0 and nreplies == nreplies_expected
 
 
-def send_request_and_process_replies(sock, multicast_group, nreplies_expected,  method, params=None, request_id=1):
+def send_request_and_process_replies(sock, multicast_group, nreplies_expected,  method, params=None, request_id=1, binary=False):
     request = {"jsonrpc": "2.0", "method": method, "params": params, "id": request_id}
     try:
-        json_request = json.dumps(request)
-    except TypeError as e:
-        log("Failed to JSON encode message '{0}': {1}".format(request, e))
+        datagrams = encode_request(request, binary)
+    except (TypeError, ValueError) as e:
+        log("Failed to encode message '{0}': {1}".format(request, e))
         return False
 
     # Retry loop. Keep sending the same request until we get replies from all servers.
     while True:
-        log("Sending request to servers: {0}".format(json_request))
+        log("Sending {0} request to servers: {1}".format("binary" if binary else "JSON", request))
         # Send data to the multicast group.
-        sent = sock.sendto(json_request, multicast_group)
+        for datagram in datagrams:
+            sock.sendto(datagram, multicast_group)
 
         if received_all_replies(sock, nreplies_expected):
             break
@@ -310,6 +537,93 @@ def send_request_and_process_replies(sock, multicast_group, nreplies_expected,
     return True
 
 
+def send_request_to_walls_and_process_replies(walls, method, params_per_wall, request_id=1):
+    """ Sends a request to several walls and concurrently waits for all their replies, retrying each wall on its own. """
+    pending_walls = {}
+    wire_reassembler = panodpf_wire.Reassembler()
+    for wall in walls:
+        request = {"jsonrpc": "2.0", "method": method, "params": params_per_wall[wall['name']], "id": request_id}
+        # A last send time of 'None' makes the loop below send the request right away.
+        pending_walls[wall['sock']] = {"wall": wall, "request": request, "reply_set": set(), "binary_reply_set": set(), "sent_binary": False,
+                                       "last_send_time": None, "poll_time": None}
+
+    while pending_walls:
+        now = monotonic_time()
+        wait_time = None
+        for state in pending_walls.values():
+            wall = state['wall']
+            if state['last_send_time'] is not None and now - state['last_send_time'] >= wall['server_timeout_wait']:
+                log("Got {0} out of {1} replies from wall '{2}'. Retrying ...".format(len(state['reply_set']), wall['total_displays'], wall['name']))
+                state['last_send_time'] = None
+                # An older server might have joined the wall. Retry in JSON, we switch back once all servers advertise
+                # the binary wire protocol again.
+                if wall['binary'] and not wall['force_binary']:
+                    log("Falling back to JSON requests for wall '{0}' ...".format(wall['name']))
+                    wall['binary'] = False
+            elif state['poll_time'] is not None and now >= state['poll_time']:
+                log("Polling wall '{0}' for pending replies ...".format(wall['name']))
+                state['last_send_time'] = None
+
+            if state['last_send_time'] is None:
+                log("Sending {0} request to wall '{1}': {2}".format("binary" if wall['binary'] else "JSON", wall['name'], state['request']))
+                try:
+                    datagrams = encode_request(state['request'], wall['binary'])
+                except (TypeError, ValueError) as e:
+                    log("Failed to encode message '{0}' for wall '{1}': {2}".format(state['request'], wall['name'], e))
+                    del pending_walls[wall['sock']]
+                    continue
+
+                for datagram in datagrams:
+                    wall['sock'].sendto(datagram, wall['multicast_group'])
+                state['sent_binary'] = state['sent_binary'] or wall['binary']
+                state['last_send_time'] = now
+                state['poll_time'] = None
+
+            remaining_time = state['last_send_time'] + wall['server_timeout_wait'] - now
+            if state['poll_time'] is not None:
+                remaining_time = min(remaining_time, state['poll_time'] - now)
+            wait_time = remaining_time if wait_time is None else min(wait_time, remaining_time)
+
+        if not pending_walls:
+            break
+
+        readable_socks, _, _ = select.select(pending_walls.keys(), [], [], max(0, wait_time))
+        for sock in readable_socks:
+            state = pending_walls[sock]
+            wall = state['wall']
+            datagram, server = sock.recvfrom(panodpf_wire.WIRE_MAX_DATAGRAM_SIZE)
+            reply = decode_reply(datagram, server, wire_reassembler)
+            if not reply:
+                continue
+
+            # Ignore late replies to earlier requests, they could otherwise be counted as ACKs for this one.
+            if reply.get('id') != request_id:
+                continue
+
+            log("Received '{0}' from {1} on wall '{2}'".format(reply, server, wall['name']))
+            # The server is still working on it. Ask again shortly instead of waiting for the retry timeout.
+            if reply.get('result') == FINISH_PANO_PENDING:
+                if state['poll_time'] is None:
+                    state['poll_time'] = monotonic_time() + FINISH_PANO_POLL_INTERVAL
+                continue
+
+            state['reply_set'].add(reply.get('current_display'))
+            if panodpf_wire.WIRE_VERSION in reply.get('wire_versions', []):
+                state['binary_reply_set'].add(reply.get('current_display'))
+
+            if len(state['reply_set']) == wall['total_displays']:
+                log("Got all {0} replies from wall '{1}'.".format(wall['total_displays'], wall['name']))
+                del pending_walls[sock]
+
+                # Switch to the binary wire protocol once all servers of the wall advertised it in reply to a JSON
+                # request, so we know every one of them can decode it.
+                if not state['sent_binary'] and len(state['binary_reply_set']) == wall['total_displays']:
+                    log("All servers of wall '{0}' support wire protocol version {1}. Switching to binary requests ...".format(wall['name'], panodpf_wire.WIRE_VERSION))
+                    wall['binary'] = True
+
+    return True
+
+
 def set_up_networking(multicast_address, multicast_port, server_timeout_wait=5):
     multicast_group = (multicast_address, multicast_port)
 
@@ -359,43 +673,89 @@ def get_annotation_info(pano_path):
             "font_opacity": font_opacity}
 
 
-def send_process_pano_request(sock, multicast_group, request_id, pano_path):
-    # Get settings.
-    total_displays = int(__addon__.getSetting('total_displays')) + 1
-    rotation = int(__addon__.getSetting('rotation'))
+def get_wall_setting(wall_prefix, setting_id):
+    return __addon__.getSetting(wall_prefix + setting_id)
+
+
+def build_wall(name, wall_prefix, server_timeout_wait):
+    multicast_address = get_wall_setting(wall_prefix, 'multicast_address')
+    multicast_port = int(get_wall_setting(wall_prefix, 'multicast_port'))
+    sock, multicast_group = set_up_networking(multicast_address, multicast_port, server_timeout_wait)
+    force_binary = __addon__.getSetting('binary_protocol').lower() == "true"
+
+    return {"name": name,
+            "prefix": wall_prefix,
+            "sock": sock,
+            "multicast_group": multicast_group,
+            "server_timeout_wait": server_timeout_wait,
+            # Requests are sent as JSON until all servers of the wall advertise the binary wire protocol, unless the
+            # user forces the binary wire protocol.
+            "binary": force_binary,
+            "force_binary": force_binary}
+
+
+def update_wall_settings(wall):
+    # These settings do not need a restart so we read them before every slide.
+    wall['total_displays'] = int(get_wall_setting(wall['prefix'], 'total_displays')) + 1
+    wall['rotation'] = int(get_wall_setting(wall['prefix'], 'rotation'))
+    wall['display_schedule_type'] = DISPLAY_SCHEDULE_TYPE_MAPPING[int(get_wall_setting(wall['prefix'], 'display_schedule_type'))]
+
+
+def get_walls(server_timeout_wait):
+    walls = [build_wall("Wall 1", "", server_timeout_wait)]
+
+    for wall_number in xrange(2, MAX_WALLS + 1):
+        wall_prefix = "wall{0}_".format(wall_number)
+        if get_wall_setting(wall_prefix, 'enabled').lower() == "true":
+            walls.append(build_wall("Wall {0}".format(wall_number), wall_prefix, server_timeout_wait))
+
+    log("Driving {0} wall(s): {1}".format(len(walls), ", ".join("{0} ({1}:{2})".format(w['name'], *w['multicast_group']) for w in walls)))
+    return walls
+
+
+def send_process_pano_request(walls, request_id, pano_path, progressive=False):
+    annotate = get_annotation_info(pano_path)
 
     # Build, send request and wait for all replies.
-    process_pano_params = {"path": pano_path, "rotation": rotation, "total_displays": total_displays, "annotate": get_annotation_info(pano_path)}
-    send_request_and_process_replies(sock, multicast_group, total_displays, "process_pano", process_pano_params, request_id)
+    params_per_wall = {}
+    for wall in walls:
+        params_per_wall[wall['name']] = {"path": pano_path, "rotation": wall['rotation'], "total_displays": wall['total_displays'], "annotate": annotate,
+                                         "progressive": progressive}
+    send_request_to_walls_and_process_replies(walls, "process_pano", params_per_wall, request_id)
 
 
-def send_display_pano_request(sock, multicast_group, request_id, pano_path):
-    # Get settings.
-    total_displays = int(__addon__.getSetting('total_displays')) + 1
-    display_schedule_type_idx = int(__addon__.getSetting('display_schedule_type'))
+def send_display_pano_request(walls, request_id, pano_path, flat_schedule=False):
     delay_increment_idx = int(__addon__.getSetting('delay_increment'))
-    # log("display_schedule_type_idx = {0}  delay_increment_idx = {1}".format(display_schedule_type_idx, delay_increment_idx))
-    display_schedule_type = DISPLAY_SCHEDULE_TYPE_MAPPING[display_schedule_type_idx]
     delay_increment = DELAY_INCREMENT_MAPPING[delay_increment_idx]
-    # log("display_schedule_type = {0}  delay_increment = {1}".format(display_schedule_type, delay_increment))
+    # log("delay_increment = {0}".format(delay_increment))
+
+    params_per_wall = {}
+    for wall in walls:
+        display_schedule_type = 'Flat' if flat_schedule else wall['display_schedule_type']
+        params_per_wall[wall['name']] = {"path": pano_path, "total_displays": wall['total_displays'],
+                                         "display_schedule": get_display_schedule(display_schedule_type, wall['total_displays'], delay_increment)}
+    send_request_to_walls_and_process_replies(walls, "display_pano", params_per_wall, request_id)
 
-    display_pano_params = {"path": pano_path, "total_displays": total_displays,
-                           "display_schedule": get_display_schedule(display_schedule_type, total_displays, delay_increment)}
-    send_request_and_process_replies(sock, multicast_group, total_displays, "display_pano", display_pano_params, request_id)
+
+def send_finish_pano_request(walls, request_id, pano_path):
+    # Servers reply 'Pending' until their full quality slice is ready, so this returns once the whole wall can swap.
+    params_per_wall = {}
+    for wall in walls:
+        params_per_wall[wall['name']] = {"path": pano_path, "total_displays": wall['total_displays']}
+    send_request_to_walls_and_process_replies(walls, "finish_pano", params_per_wall, request_id)
 
 
 def start_panodpf_client():
     # Instantiate a monitor object so we can check if we need to exit.
     monitor = xbmc.Monitor()
 
-    # Get the configuration settings.
-    multicast_address = __addon__.getSetting('multicast_address')
-    multicast_port = int(__addon__.getSetting('multicast_port'))
+    # Get the configuration settings. All walls share the library scan and playlist and show the same pano. Every
+    # server still reads and decodes the source itself, so the NAS serves each source once per server and slide.
     server_timeout_wait = int(__addon__.getSetting('server_timeout_wait'))
-
-    sock, multicast_group = set_up_networking(multicast_address, multicast_port, server_timeout_wait)
+    walls = get_walls(server_timeout_wait)
 
     request_id = 0
+    slideshow_clock = SlideshowClock(int(__addon__.getSetting('slideshow_delay')))
 
     while not monitor.abortRequested():
         pano_folder = __addon__.getSetting('dpf_folder')
@@ -412,14 +772,34 @@ def start_panodpf_client():
                 log("Could not open pano '{0}'. Namespace might have changed. Rebuilding playlist ...".format(pano_path))
                 break
 
-            send_process_pano_request(sock, multicast_group, request_id, pano_path)
+            # Servers keep showing the current slide while they process the next one, so start early enough to
+            # have it ready by the deadline.
+            slideshow_clock.wait_to_prepare()
+            for wall in walls:
+                update_wall_settings(wall)
+            progressive = True if __addon__.getSetting('progressive_display').lower() == "true" else False
+            prepare_start = slideshow_clock.clock()
+            send_process_pano_request(walls, request_id, pano_path, progressive)
+            prepare_time = slideshow_clock.clock() - prepare_start
 
             # Increment the request ID so servers don't think this request is a duplicate of the process pano request.
             request_id += 1
-            send_display_pano_request(sock, multicast_group, request_id, pano_path)
-
-            # Sleep while the image is being displayed.
-            time.sleep(int(__addon__.getSetting('slideshow_delay')))
+            slideshow_clock.wait_for_deadline()
+            slideshow_clock.set_period(int(__addon__.getSetting('slideshow_delay')))
+            slideshow_clock.slide_due()
+            send_display_pano_request(walls, request_id, pano_path)
+
+            # Servers might be showing a low resolution preview. Wait until every server has its full quality slice
+            # and then swap all of them at once. These rounds keep the client busy too, so they count as preparation.
+            if progressive:
+                finish_start = slideshow_clock.clock()
+                request_id += 1
+                send_finish_pano_request(walls, request_id, pano_path)
+                request_id += 1
+                send_display_pano_request(walls, request_id, pano_path, flat_schedule=True)
+                prepare_time += slideshow_clock.clock() - finish_start
+
+            slideshow_clock.record_prepare_time(prepare_time)
 
             # Make sure the request ID does not overflow.
             request_id = 0 if request_id >= MAX_REQUEST_ID else request_id + 1
@@ -436,7 +816,11 @@ else:
                                                             "We keep retying until we get the expected numbers of replies.")
     parser.add_argument("command", type=str, help="The command to send to the multicast group.")
     parser.add_argument("-t", "--timeout-wait", type=int, default=5, help="The amount of seconds to wait for the servers to reply before giving up.")
+    parser.add_argument("-b", "--binary", action="store_true", default=False, help="Send the request with the binary wire protocol instead of JSON.")
+    parser.add_argument("-n", "--profile-requests", type=int, default=0, help="With the 'profile' command: print the last profile report and profile the next N requests.")
     args = parser.parse_args()
 
+    params = {"requests": args.profile_requests} if args.command == "profile" else None
     sock, multicast_group = set_up_networking(args.multicast_address, args.multicast_port, server_timeout_wait=args.timeout_wait)
-    send_request_and_process_replies(sock, multicast_group, args.nreplies_expected, args.command)
+    # Servers take a request with the ID of their last one for a retry, so every run gets a fresh ID.
+    send_request_and_process_replies(sock, multicast_group, args.nreplies_expected, args.command, params, random.randint(1, MAX_REQUEST_ID), args.binary)
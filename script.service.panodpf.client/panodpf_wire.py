@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compact binary wire protocol shared by the Pano DPF client and server.
+
+Keep this file identical in 'script.service.panodpf.client' and 'script.service.panodpf.server'.
+
+Each datagram starts with a header (magic, version, message ID, fragment index, fragment count) followed by a chunk of
+the encoded message. Messages are encoded with a small msgpack style tagged format. JSON datagrams always start with
+'{' so both encodings can be told apart by the first bytes. Servers advertise the versions they support in every reply
+and clients switch a wall to binary requests once all its servers advertised them in reply to a JSON request, or right
+away if the 'binary_protocol' setting forces it.
+"""
+
+import struct
+
+WIRE_MAGIC = b"PD"
+WIRE_VERSION = 1
+WIRE_HEADER = struct.Struct(">2sBIHH")
+# Stay below the Ethernet MTU so fragments are never split again at the IP level.
+WIRE_FRAGMENT_SIZE = 1400 - WIRE_HEADER.size
+# Largest possible UDP payload. Use it for all 'recvfrom(...)' calls so no datagram is ever truncated.
+WIRE_MAX_DATAGRAM_SIZE = 65535
+WIRE_MAX_PENDING_MESSAGES = 16
+
+# Type tags.
+TAG_NONE = b"N"
+TAG_TRUE = b"T"
+TAG_FALSE = b"F"
+TAG_INT8 = b"b"
+TAG_INT16 = b"h"
+TAG_INT32 = b"i"
+TAG_INT64 = b"q"
+TAG_FLOAT = b"d"
+TAG_SHORT_STRING = b"s"
+TAG_STRING = b"S"
+TAG_SHORT_LIST = b"l"
+TAG_LIST = b"L"
+TAG_SHORT_MAP = b"m"
+TAG_MAP = b"M"
+
+INT8 = struct.Struct(">b")
+INT16 = struct.Struct(">h")
+INT32 = struct.Struct(">i")
+INT64 = struct.Struct(">q")
+FLOAT = struct.Struct(">d")
+UINT8 = struct.Struct(">B")
+UINT32 = struct.Struct(">I")
+
+
+class WireError(ValueError):
+    pass
+
+
+# Integer tags from the smallest to the biggest encoding, with their ranges.
+INTEGER_ENCODINGS = ((TAG_INT8, INT8, -2**7, 2**7 - 1),
+                     (TAG_INT16, INT16, -2**15, 2**15 - 1),
+                     (TAG_INT32, INT32, -2**31, 2**31 - 1),
+                     (TAG_INT64, INT64, -2**63, 2**63 - 1))
+INTEGER_STRUCTS = dict((tag, integer_struct) for tag, integer_struct, _, _ in INTEGER_ENCODINGS)
+
+
+def _encode_length(length, short_tag, tag):
+    # Strings, lists and maps shorter than 256 items only need one byte for their length.
+    return short_tag + UINT8.pack(length) if length < 256 else tag + UINT32.pack(length)
+
+
+def _encode_value(value, chunks):
+    if value is None:
+        chunks.append(TAG_NONE)
+    elif value is True:
+        chunks.append(TAG_TRUE)
+    elif value is False:
+        chunks.append(TAG_FALSE)
+    elif isinstance(value, (int, long)):
+        for tag, integer_struct, min_value, max_value in INTEGER_ENCODINGS:
+            if min_value <= value <= max_value:
+                chunks.append(tag + integer_struct.pack(value))
+                break
+        else:
+            raise WireError("Integer '{0}' does not fit in 64 bits.".format(value))
+    elif isinstance(value, float):
+        chunks.append(TAG_FLOAT + FLOAT.pack(value))
+    elif isinstance(value, basestring):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        chunks.append(_encode_length(len(value), TAG_SHORT_STRING, TAG_STRING) + value)
+    elif isinstance(value, (list, tuple)):
+        chunks.append(_encode_length(len(value), TAG_SHORT_LIST, TAG_LIST))
+        for item in value:
+            _encode_value(item, chunks)
+    elif isinstance(value, dict):
+        chunks.append(_encode_length(len(value), TAG_SHORT_MAP, TAG_MAP))
+        for key, item in value.items():
+            _encode_value(key, chunks)
+            _encode_value(item, chunks)
+    else:
+        raise WireError("Cannot encode value '{0}' of type '{1}'.".format(value, type(value)))
+
+
+def _decode_length(data, offset, short):
+    length_struct = UINT8 if short else UINT32
+    return length_struct.unpack_from(data, offset)[0], offset + length_struct.size
+
+
+def _decode_value(data, offset):
+    tag = data[offset:offset + 1]
+    offset += 1
+
+    if tag == TAG_NONE:
+        return None, offset
+    if tag == TAG_TRUE:
+        return True, offset
+    if tag == TAG_FALSE:
+        return False, offset
+    if tag in INTEGER_STRUCTS:
+        integer_struct = INTEGER_STRUCTS[tag]
+        return integer_struct.unpack_from(data, offset)[0], offset + integer_struct.size
+    if tag == TAG_FLOAT:
+        return FLOAT.unpack_from(data, offset)[0], offset + FLOAT.size
+    if tag in (TAG_SHORT_STRING, TAG_STRING):
+        length, offset = _decode_length(data, offset, tag == TAG_SHORT_STRING)
+        if offset + length > len(data):
+            raise WireError("Truncated string at offset {0}.".format(offset))
+        # Decode to unicode just like 'json.loads(...)' does.
+        return data[offset:offset + length].decode("utf-8"), offset + length
+    if tag in (TAG_SHORT_LIST, TAG_LIST):
+        count, offset = _decode_length(data, offset, tag == TAG_SHORT_LIST)
+        items = []
+        for _ in xrange(count):
+            item, offset = _decode_value(data, offset)
+            items.append(item)
+        return items, offset
+    if tag in (TAG_SHORT_MAP, TAG_MAP):
+        count, offset = _decode_length(data, offset, tag == TAG_SHORT_MAP)
+        items = {}
+        for _ in xrange(count):
+            key, offset = _decode_value(data, offset)
+            items[key], offset = _decode_value(data, offset)
+        return items, offset
+
+    raise WireError("Unknown type tag '{0}' at offset {1}.".format(tag, offset - 1))
+
+
+def encode(value):
+    chunks = []
+    _encode_value(value, chunks)
+    return b"".join(chunks)
+
+
+def decode(data):
+    try:
+        value, offset = _decode_value(data, 0)
+    except struct.error as e:
+        raise WireError("Truncated message: {0}".format(e))
+    except UnicodeDecodeError as e:
+        raise WireError("Invalid UTF-8 string: {0}".format(e))
+    except TypeError as e:
+        # Lists and maps are not hashable, so they cannot be map keys.
+        raise WireError("Invalid map key: {0}".format(e))
+    except RuntimeError as e:
+        raise WireError("Message nested too deeply: {0}".format(e))
+
+    if offset != len(data):
+        raise WireError("Found {0} trailing bytes after message.".format(len(data) - offset))
+
+    return value
+
+
+def is_wire_datagram(datagram):
+    return datagram[:len(WIRE_MAGIC)] == WIRE_MAGIC
+
+
+def build_datagrams(message, message_id, fragment_size=WIRE_FRAGMENT_SIZE):
+    """ Encodes a message and splits it into datagrams of at most 'fragment_size' payload bytes each. """
+    data = encode(message)
+    chunks = [data[i:i + fragment_size] for i in xrange(0, len(data), fragment_size)]
+    message_id &= 0xFFFFFFFF
+    return [WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, message_id, idx, len(chunks)) + chunk for idx, chunk in enumerate(chunks)]
+
+
+class Reassembler(object):
+    """ Collects fragments per sender and message ID and returns each message once all its fragments arrived. """
+
+    def __init__(self, max_pending_messages=WIRE_MAX_PENDING_MESSAGES):
+        self.max_pending_messages = max_pending_messages
+        # Maps (address, message ID) to the fragment count and a dict of fragment index to fragment data.
+        self.pending_messages = {}
+        self.pending_order = []
+
+    def feed(self, datagram, address):
+        try:
+            magic, version, message_id, fragment_idx, nfragments = WIRE_HEADER.unpack_from(datagram)
+        except struct.error as e:
+            raise WireError("Truncated header: {0}".format(e))
+
+        if version != WIRE_VERSION:
+            raise WireError("Unsupported wire protocol version {0}.".format(version))
+
+        if fragment_idx >= nfragments:
+            raise WireError("Invalid fragment {0} of {1}.".format(fragment_idx, nfragments))
+
+        if nfragments == 1:
+            return decode(datagram[WIRE_HEADER.size:])
+
+        key = (address, message_id)
+        if key not in self.pending_messages:
+            # Drop the oldest incomplete message. Its sender retries if it still needs an answer.
+            if len(self.pending_order) >= self.max_pending_messages:
+                self.pending_messages.pop(self.pending_order.pop(0), None)
+            self.pending_messages[key] = (nfragments, {})
+            self.pending_order.append(key)
+
+        expected_nfragments, fragments = self.pending_messages[key]
+        if nfragments != expected_nfragments:
+            # Drop the whole message, its sender retries with consistent fragments.
+            del self.pending_messages[key]
+            self.pending_order.remove(key)
+            raise WireError("Fragment {0} of {1} does not match the {2} fragments of message {3}.".format(fragment_idx, nfragments, expected_nfragments, message_id))
+
+        fragments[fragment_idx] = datagram[WIRE_HEADER.size:]
+        if len(fragments) < nfragments:
+            return None
+
+        del self.pending_messages[key]
+        self.pending_order.remove(key)
+        try:
+            data = b"".join(fragments[i] for i in xrange(nfragments))
+        except KeyError as e:
+            raise WireError("Missing fragment {0} of message {1}.".format(e, message_id))
+
+        return decode(data)
@@ -2,16 +2,71 @@ import io
 import os
 import json
 import time
+import zlib
+import base64
+import pstats
+import cProfile
 import xbmc
+import shutil
 import socket
 import struct
 import xbmcvfs
+import threading
 import xbmcaddon
+import panodpf_wire
 
-from PIL import Image, ImageDraw, ImageFont
+from collections import OrderedDict
+from PIL import Image, ImageDraw, ImageFont, ImageSequence
+
+# 'tracemalloc' is only part of the standard library starting with Python 3.4. Use the backport if it is installed.
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 PANO_TMP_FOLDER = "/tmp"
 
+# Tiled pyramid constants. Must match the ingest tool in 'match_pics_by_format_factor.py'.
+PYRAMID_EXTENSION = ".pyramid"
+PYRAMID_INDEX_FILE_NAME = "index.json"
+PYRAMID_TILE_EXTENSION = "jpg"
+PYRAMID_VERSION = 1
+
+# Slice store defaults.
+SLICE_STORE_SUBFOLDER = "panodpf"
+SLICE_STORE_RAM_FOLDER = "/dev/shm"
+SLICE_STORE_DISK_FOLDER = PANO_TMP_FOLDER
+SLICE_STORE_BACKEND_MAPPING = {0: SLICE_STORE_RAM_FOLDER, 1: SLICE_STORE_DISK_FOLDER}
+SLICE_STORE_BUDGET_MB_DEFAULT = 32
+
+# Progressive display settings. Previews are decoded from JPEGs in draft mode at this fraction of the full size.
+PREVIEW_DRAFT_SCALE = 1.0/8
+PREVIEW_SUFFIX = "preview"
+PREVIEW_EXTENSIONS = (".jpg", ".jpeg")
+# 'finish_pano' result while the full quality slice is still rendering. The client polls until it gets a slice path.
+FINISH_PANO_PENDING = "Pending"
+
+# Animated GIF settings.
+ANIMATED_EXTENSION = ".gif"
+ANIMATED_FRAME_DURATION_DEFAULT = 100
+# GIF disposal methods 2 (restore to background) and 3 (restore to previous) change pixels when the next frame loads.
+ANIMATED_RESTORING_DISPOSAL_METHODS = (2, 3)
+# Slice frames are complete opaque pictures, so each one is simply kept on screen until the next one (disposal method 1).
+ANIMATED_DISPOSAL_KEEP = 1
+
+# Profiling settings.
+PROFILE_TOP_FUNCTIONS = 15
+PROFILE_TOP_ALLOCATIONS = 10
+PROFILE_TRACEMALLOC_FRAMES = 1
+
+# JSON replies with a payload are split into fragments that fit in the 'recvfrom(1024)' of older clients.
+REPLY_FRAGMENT_SIZE = 640
+
 # Annotation defaults.
 ANNOTATION_TEXT_DEFAULT = ""
 ANNOTATION_TEXT_OFFSET_DEFAULT = (50, 50)
@@ -23,35 +78,212 @@ __addon__      = xbmcaddon.Addon()
 __cwd__        = __addon__.getAddonInfo('path').decode("utf-8")
 
 full_pano_path_to_pano_slice_path = {}
+slice_store = None
+full_slice_renderer = None
+animated_pano_slice_paths = set()
+profile_session = None
+profile_report = None
+profile_lock = threading.Lock()
+last_profile_request_id = None
+wire_reassembler = panodpf_wire.Reassembler()
 
 
 def safe_remove_file(full_file_path):
     if not full_file_path:
         return
 
+    # Never remove the slice Kodi is showing. The slice store removes it once another slice replaces it on screen.
+    if slice_store and slice_store.defer_removal_if_displayed(full_file_path):
+        return
+
     try:
         os.remove(full_file_path)
     except EnvironmentError:
         pass
 
+    if slice_store:
+        slice_store.forget(full_file_path)
+    animated_pano_slice_paths.discard(full_file_path)
+
+
+########################################################################################################################
+# Slice store APIs.                                                                                                    #
+class SliceStore(object):
+    """ Stores pano slices in a RAM (tmpfs) or disk backed folder while keeping the RAM folder within a memory budget. """
+
+    def __init__(self, backend_folder=SLICE_STORE_RAM_FOLDER, budget_mb=SLICE_STORE_BUDGET_MB_DEFAULT, fallback_folder=SLICE_STORE_DISK_FOLDER):
+        # Fall back to the disk folder if the requested backend folder (e.g. '/dev/shm') is not available on this system.
+        if not os.path.isdir(backend_folder):
+            xbmc.log("Slice store backend folder '{0}' does not exist. Using '{1}' instead.".format(backend_folder, fallback_folder), level=xbmc.LOGWARNING)
+            backend_folder = fallback_folder
+
+        self.folder = os.path.join(backend_folder, SLICE_STORE_SUBFOLDER)
+        self.fallback_folder = os.path.join(fallback_folder, SLICE_STORE_SUBFOLDER)
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self.used_bytes = 0
+        # Maps slice paths stored in 'self.folder' to their sizes in insertion order so we can evict the oldest first.
+        self.slices = OrderedDict()
+        self.displayed_path = None
+        self.pending_removals = set()
+        # Full quality slices are saved from a background thread while the main loop displays and removes slices.
+        self.lock = threading.RLock()
+
+        for folder in set([self.folder, self.fallback_folder]):
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+        xbmc.log("Created slice store in '{0}' with a {1} MB budget (fallback folder '{2}').".format(self.folder, budget_mb, self.fallback_folder))
+
+    def build_slice_path(self, full_pano_path, current_display, total_displays, folder=None, suffix=""):
+        return build_cropped_pano_path(full_pano_path, current_display, total_displays, folder or self.folder, suffix)
+
+    def save(self, img, full_pano_path, current_display, total_displays, suffix="", **save_params):
+        slice_path = self.build_slice_path(full_pano_path, current_display, total_displays, suffix=suffix)
+
+        # Encode in memory first so we know the slice size before it is written to the backend folder.
+        Image.init()
+        slice_format = Image.EXTENSION.get(os.path.splitext(slice_path)[1].lower())
+        slice_bytes_file = io.BytesIO()
+        img.save(slice_bytes_file, format=slice_format, **save_params)
+        slice_bytes = slice_bytes_file.getvalue()
+        slice_bytes_file.close()
+        del slice_bytes_file
+
+        with self.lock:
+            # Forget any previous copy of the same slice so it does not count against the budget twice.
+            self.forget(slice_path)
+
+            if not self._make_room(len(slice_bytes)):
+                slice_path = self.build_slice_path(full_pano_path, current_display, total_displays, self.fallback_folder, suffix)
+                xbmc.log("Slice with {0} bytes does not fit in the {1} bytes budget. Saving it to '{2}' ...".format(len(slice_bytes), self.budget_bytes, slice_path))
+
+            with open(slice_path, "wb") as fd:
+                fd.write(slice_bytes)
+
+            if slice_path.startswith(self.folder + os.sep):
+                self.slices[slice_path] = len(slice_bytes)
+                self.used_bytes += len(slice_bytes)
+
+        return slice_path
+
+    def save_streamed(self, write_slice, full_pano_path, current_display, total_displays, suffix=""):
+        """ Saves a slice too big to be encoded in memory first. 'write_slice(fd)' writes it to an open file. """
+        slice_path = self.build_slice_path(full_pano_path, current_display, total_displays, self.fallback_folder, suffix)
+        with self.lock:
+            self.forget(self.build_slice_path(full_pano_path, current_display, total_displays, suffix=suffix))
+            self.forget(slice_path)
+
+        # The size is only known once the slice is written, so write it to the fallback folder and only move it to the
+        # backend folder if it fits in the budget.
+        with open(slice_path, "wb") as fd:
+            write_slice(fd)
+        nbytes = os.path.getsize(slice_path)
+
+        with self.lock:
+            if self.folder == self.fallback_folder or not self._make_room(nbytes):
+                xbmc.log("Saved streamed slice with {0} bytes to '{1}'.".format(nbytes, slice_path))
+                return slice_path
+
+            budget_slice_path = self.build_slice_path(full_pano_path, current_display, total_displays, suffix=suffix)
+            shutil.move(slice_path, budget_slice_path)
+            self.slices[budget_slice_path] = nbytes
+            self.used_bytes += nbytes
+
+        return budget_slice_path
+
+    def _make_room(self, nbytes):
+        if self.folder == self.fallback_folder:
+            return True
+
+        if nbytes > self.budget_bytes:
+            return False
+
+        # Evict the oldest slices first, skipping the one on screen and the ones 'display_pano' might still show.
+        protected_paths = set(full_pano_path_to_pano_slice_path.values())
+        protected_paths.add(self.displayed_path)
+        for slice_path in list(self.slices.keys()):
+            if self.used_bytes + nbytes <= self.budget_bytes:
+                break
+
+            if slice_path not in protected_paths:
+                xbmc.log("Evicting slice '{0}' to stay within the slice store budget ...".format(slice_path))
+                safe_remove_file(slice_path)
+
+        return self.used_bytes + nbytes <= self.budget_bytes
+
+    def forget(self, slice_path):
+        with self.lock:
+            self.used_bytes -= self.slices.pop(slice_path, 0)
+            self.pending_removals.discard(slice_path)
+
+    def defer_removal_if_displayed(self, slice_path):
+        with self.lock:
+            if slice_path != self.displayed_path:
+                return False
+
+            self.pending_removals.add(slice_path)
+            return True
+
+    def mark_displayed(self, slice_path):
+        with self.lock:
+            self.displayed_path = slice_path
+            self.pending_removals.discard(slice_path)
+
+            # Now that a new slice is on screen we can remove the ones that were waiting for it to be replaced.
+            for pending_path in list(self.pending_removals):
+                if pending_path != slice_path:
+                    safe_remove_file(pending_path)
+
+    def reclaim_orphans(self):
+        """ Removes slice files left behind by a previous (crashed) server loop. """
+        on_screen_filename = xbmc.getInfoLabel('Slideshow.Filename')
+        nreclaimed = 0
+
+        for folder in set([self.folder, self.fallback_folder]):
+            for filename in os.listdir(folder):
+                slice_path = os.path.join(folder, filename)
+                if slice_path in self.slices or slice_path == self.displayed_path:
+                    continue
+
+                # Kodi might still show a slice written before the server was restarted.
+                if on_screen_filename and filename == on_screen_filename:
+                    self.displayed_path = slice_path
+                    continue
+
+                safe_remove_file(slice_path)
+                nreclaimed += 1
+
+        xbmc.log("Reclaimed {0} orphaned slice files from the slice store.".format(nreclaimed))
+        return nreclaimed
+
+
+def create_slice_store():
+    backend_idx = int(__addon__.getSetting('slice_store_backend') or 0)
+    budget_mb = int(__addon__.getSetting('slice_store_budget') or SLICE_STORE_BUDGET_MB_DEFAULT)
+    store = SliceStore(SLICE_STORE_BACKEND_MAPPING.get(backend_idx, SLICE_STORE_RAM_FOLDER), budget_mb)
+    store.reclaim_orphans()
+    return store
+# End slice store APIs.                                                                                                #
+########################################################################################################################
+
 
 ########################################################################################################################
 # Image annotation APIs.                                                                                               #
 def annotate_image(img, text, text_offset, font_file, font_size, font_opacity):
-    base = img.convert('RGBA')
-
-    # make a blank image for the text, initialized to transparent text color
-    txt = Image.new('RGBA', base.size, (255,255,255,0))
-    draw = ImageDraw.Draw(txt)
+    # Only RGB images can be blended in place with a white color. Other modes (e.g. palette GIFs) need a conversion.
+    base = img if img.mode == 'RGB' else img.convert('RGB')
 
     # font = ImageFont.truetype(<font-file>, <font-size>)
     f = ImageFont.truetype(font_file, font_size)
-    text_coordinates = get_text_coordinates(img, text, text_offset, f)
+    text_coordinates = get_text_coordinates(base, text, text_offset, f)
 
-    # draw text,with specified transparency
-    draw.text(text_coordinates, text, font=f, fill=(255, 255, 255, font_opacity))
+    # Draw the text into a mask that only covers the text area instead of a full size RGBA overlay.
+    # The mask value is the font opacity so pasting white through it blends just like an alpha composite.
+    txt_mask = Image.new('L', f.getsize(text), 0)
+    ImageDraw.Draw(txt_mask).text((0, 0), text, font=f, fill=font_opacity)
+    base.paste((255, 255, 255), text_coordinates, txt_mask)
 
-    return Image.alpha_composite(base, txt)
+    return base
 
 
 def get_text_coordinates(img, text, text_offset, font_object):
@@ -86,28 +318,167 @@ def annotate_image_if_needed(params, img, current_display, total_displays):
 ########################################################################################################################
 
 
+########################################################################################################################
+# Tiled pyramid APIs.                                                                                                  #
+def is_pyramid_path(full_pano_path):
+    return full_pano_path.rstrip("/").endswith(PYRAMID_EXTENSION)
+
+
+def read_xbmc_file_bytes(full_file_path):
+    xbmc_file = xbmcvfs.File(xbmc.translatePath(full_file_path))
+    try:
+        return xbmc_file.readBytes()
+    finally:
+        xbmc_file.close()
+
+
+def load_pyramid_index(pyramid_path):
+    index = json.loads(str(read_xbmc_file_bytes(os.path.join(pyramid_path, PYRAMID_INDEX_FILE_NAME))))
+    if index.get('version') != PYRAMID_VERSION:
+        raise IOError("Unsupported pyramid version '{0}' in '{1}'.".format(index.get('version'), pyramid_path))
+
+    return index
+
+
+def select_pyramid_level(index, plan):
+    # Levels are ordered from full resolution down. Pick the smallest one that still has at least the target height.
+    target_height = plan['target_size'][1]
+    selected_level = index['levels'][0]
+    for level in index['levels']:
+        if level['height'] < target_height:
+            break
+        selected_level = level
+
+    return selected_level
+
+
+def read_pyramid_strip(pyramid_path, chunk, tchunks, rotation):
+    """ Assembles the strip for a display from the tiles that cover it at the nearest pyramid level. """
+    index = load_pyramid_index(pyramid_path)
+    level = select_pyramid_level(index, plan_pano_transform((index['width'], index['height']), chunk, tchunks, rotation, get_screen_size()))
+
+    # Plan again against the selected level so the crop box is in level coordinates.
+    plan = plan_pano_transform((level['width'], level['height']), chunk, tchunks, rotation, get_screen_size())
+    x0, y0, x1, y1 = plan['crop_box']
+    tile_size = index['tile_size']
+    level_folder = os.path.join(pyramid_path, str(level['level']))
+    xbmc.log("Reading strip {0} from pyramid level {1} with size ({2}, {3}) ...".format(plan['crop_box'], level['level'], level['width'], level['height']))
+
+    cim = Image.new('RGB', (x1 - x0, y1 - y0))
+    for column in xrange(x0/tile_size, (x1 - 1)/tile_size + 1):
+        for row in xrange(y0/tile_size, (y1 - 1)/tile_size + 1):
+            tile_path = os.path.join(level_folder, "{0}_{1}.{2}".format(column, row, index['tile_extension']))
+            tile = Image.open(io.BytesIO(read_xbmc_file_bytes(tile_path)))
+            cim.paste(tile, (column*tile_size - x0, row*tile_size - y0))
+            del tile
+
+    return cim, plan
+# End tiled pyramid APIs.                                                                                              #
+########################################################################################################################
+
+
 ########################################################################################################################
 # Image processing APIs.                                                                                               #
-def crop_pano(im, chunk, tchunks):
+def get_screen_size():
+    try:
+        return int(xbmc.getInfoLabel('System.ScreenWidth')), int(xbmc.getInfoLabel('System.ScreenHeight'))
+    except ValueError:
+        return None
+
+
+def plan_pano_transform(pano_size, chunk, tchunks, rotation, screen_size):
+    """ Computes the crop box, transpose method and target size that turn the full pano into the final slice. """
+    w, h = pano_size
+    crop_box = ((chunk - 1)*w/tchunks, 0, chunk*w/tchunks, h)
+    slice_w, slice_h = crop_box[2] - crop_box[0], h
+
+    # A 90 degrees rotation is a lossless transpose that does not need the generic affine 'rotate(...)'.
+    transpose_method = None
+    if rotation != 1:
+        transpose_method = Image.ROTATE_90 if rotation == 0 else Image.ROTATE_270
+
+    # Compute the scale in the unrotated orientation so we can resize before transposing. We only ever scale down.
+    scale = 1.0
+    if screen_size and all(screen_size):
+        screen_w, screen_h = screen_size if transpose_method is None else (screen_size[1], screen_size[0])
+        scale = min(1.0, float(screen_w)/slice_w, float(screen_h)/slice_h)
+
+    target_size = (max(1, int(round(slice_w*scale))), max(1, int(round(slice_h*scale))))
+    return {"crop_box": crop_box, "transpose": transpose_method, "scale": scale, "target_size": target_size}
+
+
+def plan_and_draft_pano(im, chunk, tchunks, rotation, preview=False):
+    plan = plan_pano_transform(im.size, chunk, tchunks, rotation, get_screen_size())
+
+    # Previews are decoded at the smallest draft size no matter what the screen size is.
+    if preview:
+        plan['scale'] = min(plan['scale'], PREVIEW_DRAFT_SCALE)
+
+    # JPEGs can be decoded directly at 1/2, 1/4 or 1/8 scale. Let the decoder do most of the reduction before any
+    # pixels are materialised, then plan again against the (slightly bigger than needed) draft size.
+    if plan['scale'] < 1.0 and im.format == 'JPEG':
+        w, h = im.size
+        im.draft(im.mode, (int(w*plan['scale']) + 1, int(h*plan['scale']) + 1))
+        if im.size != (w, h):
+            xbmc.log("Decoding pic with size ({0}, {1}) in draft mode with size {2} ...".format(w, h, im.size))
+            plan = plan_pano_transform(im.size, chunk, tchunks, rotation, get_screen_size())
+
+    return plan
+
+
+def crop_pano(im, crop_box):
     w, h = im.size
-    xbmc.log("Pic size: ({0}, {1})  Crop coordinates: ({2}, {3}, {4}, {5})".format(w, h, (chunk - 1)*w/tchunks, 0, chunk*w/tchunks, h))
-    cim = im.crop(((chunk - 1)*w/tchunks, 0, chunk*w/tchunks, h))
+    xbmc.log("Pic size: ({0}, {1})  Crop coordinates: {2}".format(w, h, crop_box))
+    cim = im.crop(crop_box)
+    return cim
+
+
+def load_and_transform_pano_strip(params, full_pano_path, current_display, total_displays, preview=False):
+    cim, plan = load_pano_strip(params, full_pano_path, current_display, total_displays, preview)
+    if cim is None:
+        return None
+
+    # Resize first so the transpose runs on the smaller buffer. 'cim' is the only reference to the strip, so each
+    # step frees its input right away and there is never more than one full size intermediate image alive.
+    if cim.size != plan['target_size']:
+        xbmc.log("Resizing image from {0} to {1} ...".format(cim.size, plan['target_size']))
+        resized_cim = cim.resize(plan['target_size'], resample=Image.LANCZOS)
+        del cim
+        cim = resized_cim
+
+    if plan['transpose'] is not None:
+        xbmc.log("Rotating image with size {0} 90 degrees {1}CW ...".format(cim.size, "C" if plan['transpose'] == Image.ROTATE_90 else ""))
+        transposed_cim = cim.transpose(plan['transpose'])
+        del cim
+        cim = transposed_cim
+
     return cim
 
 
-def build_cropped_pano_path(full_pano_path, current_display, total_displays, cropped_pano_folder=PANO_TMP_FOLDER):
-    pano_filename = os.path.basename(full_pano_path)
+def build_cropped_pano_path(full_pano_path, current_display, total_displays, cropped_pano_folder=PANO_TMP_FOLDER, suffix=""):
+    pano_filename = os.path.basename(full_pano_path.rstrip("/"))
     imgname, imgext = pano_filename.split('.')
-    cropped_pano_name = "{0}{1}of{2}.{3}".format(imgname, current_display, total_displays, imgext)
+    # Slices read from a pyramid are encoded just like its tiles.
+    if is_pyramid_path(full_pano_path):
+        imgext = PYRAMID_TILE_EXTENSION
+    cropped_pano_name = "{0}{1}of{2}{3}.{4}".format(imgname, current_display, total_displays, suffix, imgext)
     return os.path.join(cropped_pano_folder, cropped_pano_name)
 
 
-def crop_and_save_pano(params, full_pano_path, current_display, total_displays, cropped_pano_folder=PANO_TMP_FOLDER):
+def load_pano_strip(params, full_pano_path, current_display, total_displays, preview=False):
+    if is_pyramid_path(full_pano_path):
+        # Pyramid strips are read at the screen resolution already, a preview would not be any cheaper.
+        if preview:
+            return None, None
+        return read_pyramid_strip(full_pano_path, current_display, total_displays, params.get('rotation', 1))
+
     pano_file = xbmcvfs.File(xbmc.translatePath(full_pano_path))
     pano_bytes_file = io.BytesIO(pano_file.readBytes())
 
     im = Image.open(pano_bytes_file)
-    cim = crop_pano(im, current_display, total_displays)
+
+    plan = plan_and_draft_pano(im, current_display, total_displays, params.get('rotation', 1), preview)
+    cim = crop_pano(im, plan['crop_box'])
 
     # Release unneeded memory right away to keep memory consumption down.
     del im
@@ -116,27 +487,203 @@ def crop_and_save_pano(params, full_pano_path, current_display, total_displays,
     pano_bytes_file.close()
     del pano_bytes_file
 
-    rotation = params.get('rotation', 1)
+    return cim, plan
 
-    if rotation != 1:
-        rotation_angle = 90 if rotation == 0 else -90
-        xbmc.log("Rotating image with size {0} 90 degrees {1}CW ...".format(cim.size, "C" if rotation == 0 else ""))
-        rotated_cim = cim.rotate(rotation_angle, expand=1)
-        del cim
-        cim = rotated_cim
+
+def crop_and_save_pano(params, full_pano_path, current_display, total_displays, preview=False):
+    if full_pano_path.lower().endswith(ANIMATED_EXTENSION):
+        # There is no cheap preview for animated panos.
+        return None if preview else crop_and_save_animated_pano(params, full_pano_path, current_display, total_displays)
+
+    cim = load_and_transform_pano_strip(params, full_pano_path, current_display, total_displays, preview)
+    if cim is None:
+        return None
+
+    # Previews are only on screen for a moment so they are not annotated.
+    if preview:
+        return slice_store.save(cim, full_pano_path, current_display, total_displays, PREVIEW_SUFFIX)
 
     final_im = annotate_image_if_needed(params, cim, current_display, total_displays)
-    cropped_pano_path = build_cropped_pano_path(full_pano_path, current_display, total_displays, cropped_pano_folder)
-    final_im.save(cropped_pano_path)
+    return slice_store.save(final_im, full_pano_path, current_display, total_displays)
+
+
+def boxes_intersect(box1, box2):
+    return box1[0] < box2[2] and box2[0] < box1[2] and box1[1] < box2[3] and box2[1] < box1[3]
+
+
+def sliced_animated_frames(im, plan, params, current_display, total_displays):
+    """ Yields one slice frame per source frame that changes the strip, streaming through the source frames. """
+    crop_box = plan['crop_box']
+    pending_frame = None
+    previous_region = None
+    previous_disposal_method = 0
+    nframes = nskipped = 0
+
+    for frame in ImageSequence.Iterator(im):
+        nframes += 1
+        duration = frame.info.get('duration', ANIMATED_FRAME_DURATION_DEFAULT)
+
+        # The tile holds the region this frame updates. It has to be read before the frame is loaded by 'crop(...)'.
+        region = frame.tile[0][1] if frame.tile else None
+        visible = (pending_frame is None or region is None or boxes_intersect(region, crop_box) or
+                   (previous_disposal_method in ANIMATED_RESTORING_DISPOSAL_METHODS and previous_region and boxes_intersect(previous_region, crop_box)))
+        previous_region, previous_disposal_method = region, getattr(frame, 'disposal_method', 0)
+
+        # No display can see changes outside of its strip, so we just show the previous slice frame for longer.
+        if not visible:
+            pending_frame.info['duration'] += duration
+            nskipped += 1
+            continue
+
+        if pending_frame is not None:
+            yield pending_frame
+
+        cim = frame.crop(crop_box)
+        if cim.mode not in ('RGB', 'RGBA'):
+            cim = cim.convert('RGB')
+        cim = resize_and_transpose_frame(cim, plan)
+        pending_frame = annotate_image_if_needed(params, cim, current_display, total_displays)
+        pending_frame.info['duration'] = duration
+
+    if pending_frame is not None:
+        yield pending_frame
+
+    xbmc.log("Sliced {0} animated frames. Skipped {1} frames that do not change slice {2} of {3}.".format(nframes, nskipped, current_display, total_displays))
+
+
+def resize_and_transpose_frame(cim, plan):
+    # Same steps as 'load_and_transform_pano_strip(...)' without logging for every single frame.
+    if cim.size != plan['target_size']:
+        cim = cim.resize(plan['target_size'], resample=Image.LANCZOS)
+
+    if plan['transpose'] is not None:
+        cim = cim.transpose(plan['transpose'])
+
+    return cim
+
+
+def read_gif_sub_blocks(data, offset):
+    # Sub-blocks are length prefixed and end with an empty one.
+    while True:
+        length = struct.unpack_from("B", data, offset)[0]
+        offset += 1 + length
+        if not length:
+            return offset
+
+
+def encode_gif_frame(frame):
+    """ Encodes an opaque frame as a GIF image block with a local color table. """
+    frame_bytes_file = io.BytesIO()
+    frame.save(frame_bytes_file, format='GIF')
+    data = frame_bytes_file.getvalue()
+    frame_bytes_file.close()
+    del frame_bytes_file
+
+    # Skip the header and logical screen descriptor and remember the global color table that holds the frame's palette.
+    packed = struct.unpack_from("B", data, 10)[0]
+    offset = 13
+    color_table_flags = 0
+    color_table = b""
+    if packed & 0x80:
+        color_table_flags = 0x80 | (packed & 0x07)
+        color_table = data[offset:offset + 3 * (2 << (packed & 0x07))]
+        offset += len(color_table)
+
+    # Skip extensions, 'write_animated_gif(...)' writes its own graphic control extension for each frame.
+    while data[offset:offset + 1] == b"!":
+        offset = read_gif_sub_blocks(data, offset + 2)
+
+    if data[offset:offset + 1] != b",":
+        raise IOError("Unexpected block in encoded GIF frame at offset {0}.".format(offset))
+
+    descriptor = bytearray(data[offset:offset + 10])
+    offset += 10
+    if descriptor[9] & 0x80:
+        # The frame already has a local color table. It is copied along with the image data.
+        local_color_table_size = 3 * (2 << (descriptor[9] & 0x07))
+        color_table = b""
+    else:
+        local_color_table_size = 0
+        descriptor[9] |= color_table_flags
 
-    return cropped_pano_path
+    # Skip the LZW minimum code size and the image data sub-blocks.
+    image_data_end = read_gif_sub_blocks(data, offset + local_color_table_size + 1)
+    return bytes(descriptor) + color_table + data[offset:image_data_end]
+
+
+def write_animated_gif(fd, frames, loop=0):
+    """ Writes frames of the same size to an animated GIF one at a time so only the current frame is in memory. """
+    nframes = 0
+    for frame in frames:
+        if not nframes:
+            # Header, logical screen descriptor without a global color table and the looping extension.
+            fd.write(b"GIF89a" + struct.pack("<HHBBB", frame.size[0], frame.size[1], 0, 0, 0))
+            fd.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + b"\x00")
+
+        delay = int(round(frame.info.get('duration', ANIMATED_FRAME_DURATION_DEFAULT) / 10.0))
+        # Kodi shows transparent pixels on black anyway. Flattening keeps the previous frame from showing through them.
+        if frame.mode == 'RGBA':
+            opaque_frame = Image.new('RGB', frame.size)
+            opaque_frame.paste(frame, mask=frame.split()[3])
+            frame = opaque_frame
+
+        fd.write(b"!\xf9\x04" + struct.pack("<BHBB", ANIMATED_DISPOSAL_KEEP << 2, delay, 0, 0))
+        fd.write(encode_gif_frame(frame))
+        nframes += 1
+
+    fd.write(b";")
+    return nframes
+
+
+def crop_and_save_animated_pano(params, full_pano_path, current_display, total_displays):
+    """ Slices an animated pano frame by frame and writes each slice frame before the next one is sliced. """
+    pano_file = xbmcvfs.File(xbmc.translatePath(full_pano_path))
+    pano_bytes_file = io.BytesIO(pano_file.readBytes())
+    pano_file.close()
+    del pano_file
+
+    im = Image.open(pano_bytes_file)
+    plan = plan_pano_transform(im.size, current_display, total_displays, params.get('rotation', 1), get_screen_size())
+    xbmc.log("Pic size: {0}  Crop coordinates: {1}  Frames: {2}".format(im.size, plan['crop_box'], getattr(im, 'n_frames', 1)))
+
+    # Pillow's own animated GIF writer keeps every frame until it is done, so the frames are written one at a time.
+    frames = sliced_animated_frames(im, plan, params, current_display, total_displays)
+    loop = im.info.get('loop', 0)
+    write_slice = lambda fd: write_animated_gif(fd, frames, loop)
+    pano_slice_path = slice_store.save_streamed(write_slice, full_pano_path, current_display, total_displays)
+
+    if getattr(im, 'n_frames', 1) > 1:
+        animated_pano_slice_paths.add(pano_slice_path)
+    else:
+        animated_pano_slice_paths.discard(pano_slice_path)
+
+    del im
+    pano_bytes_file.close()
+    del pano_bytes_file
+
+    return pano_slice_path
 
 
 def create_pano_slice(params, full_pano_path, current_display, total_displays):
     global full_pano_path_to_pano_slice_path
 
+    # Never render two panos at once. A second full size decode could run a 512 MB board out of memory.
+    finish_full_slice_renderer()
+
+    # The slices of the previous pano are not needed anymore. The one on screen is kept until it is replaced.
+    for previous_slice_path in full_pano_path_to_pano_slice_path.values():
+        safe_remove_file(previous_slice_path)
+
     try:
-        pano_slice_path = crop_and_save_pano(params, full_pano_path, current_display, total_displays)
+        pano_slice_path = None
+        # Only JPEGs can be decoded cheaply enough for a preview. Decide on the extension so other panos are read once.
+        if params.get('progressive') and full_pano_path.lower().endswith(PREVIEW_EXTENSIONS):
+            pano_slice_path = crop_and_save_pano(params, full_pano_path, current_display, total_displays, preview=True)
+
+        if pano_slice_path:
+            start_full_slice_renderer(params, full_pano_path, current_display, total_displays)
+        else:
+            pano_slice_path = crop_and_save_pano(params, full_pano_path, current_display, total_displays)
     except IOError as e:
         xbmc.log("Failed to load and/or crop pano with path '{0}': {1}.".format(full_pano_path, e), level=xbmc.LOGWARNING)
         return None, "Failed to load and/or crop pano with path '{0}'.".format(full_pano_path)
@@ -149,6 +696,75 @@ def create_pano_slice(params, full_pano_path, current_display, total_displays):
 ########################################################################################################################
 
 
+########################################################################################################################
+# Progressive display APIs.                                                                                            #
+class FullSliceRenderer(threading.Thread):
+    """ Renders the full quality slice in the background while the preview slice is on screen. """
+
+    def __init__(self, params, full_pano_path, current_display, total_displays):
+        threading.Thread.__init__(self, name="PanoDPFFullSliceRenderer")
+        self.daemon = True
+        self.params = params
+        self.full_pano_path = full_pano_path
+        self.current_display = current_display
+        self.total_displays = total_displays
+        self.slice_path = None
+        # Register with the profiling session here, on the main thread, so the session cannot end before 'run' starts.
+        self.profiled_session = register_profiled_thread()
+
+    def run(self):
+        start = time.time()
+        thread_profile = start_thread_profiler(self.profiled_session)
+        try:
+            self.slice_path = crop_and_save_pano(self.params, self.full_pano_path, self.current_display, self.total_displays)
+        except Exception as e:
+            xbmc.log("Failed to render full quality slice for pano '{0}': {1}".format(self.full_pano_path, e), level=xbmc.LOGWARNING)
+            return
+        finally:
+            finish_thread_profiler(thread_profile)
+
+        xbmc.log("Rendered full quality slice '{0}' in {1:.2f} s.".format(self.slice_path, time.time() - start))
+
+
+def start_full_slice_renderer(params, full_pano_path, current_display, total_displays):
+    global full_slice_renderer
+
+    full_slice_renderer = FullSliceRenderer(params, full_pano_path, current_display, total_displays)
+    full_slice_renderer.start()
+
+
+def finish_full_slice_renderer():
+    """ Waits for the background render and returns its renderer so callers can pick up the full quality slice. """
+    global full_slice_renderer
+
+    renderer = full_slice_renderer
+    if not renderer:
+        return None
+
+    renderer.join()
+    full_slice_renderer = None
+
+    # Once the renderer is finished its slice is the best one we have for its pano. Nothing refers to the preview
+    # anymore, so remove it. If it is on screen the slice store removes it once the full quality slice replaces it.
+    if renderer.slice_path and renderer.full_pano_path in full_pano_path_to_pano_slice_path:
+        preview_slice_path = full_pano_path_to_pano_slice_path[renderer.full_pano_path]
+        full_pano_path_to_pano_slice_path[renderer.full_pano_path] = renderer.slice_path
+        if preview_slice_path != renderer.slice_path:
+            safe_remove_file(preview_slice_path)
+
+    return renderer
+
+
+def get_best_pano_slice_path(full_pano_path):
+    # Use the full quality slice as soon as the background render is done, even if the client did not ask to finish it.
+    if full_slice_renderer and not full_slice_renderer.is_alive():
+        finish_full_slice_renderer()
+
+    return full_pano_path_to_pano_slice_path[full_pano_path]
+# End progressive display APIs.                                                                                        #
+########################################################################################################################
+
+
 ########################################################################################################################
 # Miscellaneous APIs.                                                                                                  #
 def get_full_pano_path_from_params(params):
@@ -181,6 +797,129 @@ def apply_display_schedule(params, current_display, full_pano_path):
 ########################################################################################################################
 
 
+########################################################################################################################
+# Profiling APIs.                                                                                                      #
+def get_max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+
+
+def start_profile_session(nrequests):
+    global profile_session
+
+    # Background threads profile themselves and hand their profilers over in 'thread_profilers' once they are done.
+    profile_session = {"remaining": nrequests, "profiler": cProfile.Profile(), "thread_profilers": [], "running_threads": 0,
+                       "ended": False, "start_max_rss_kb": get_max_rss_kb()}
+    if tracemalloc:
+        tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+
+    xbmc.log("Profiling the next {0} requests{1} ...".format(nrequests, "" if tracemalloc else " (tracemalloc is not available)"))
+
+
+def register_profiled_thread():
+    """ Makes the active session wait for a thread that is about to start. Call it before starting the thread. """
+    session = profile_session
+    if not session:
+        return None
+
+    with profile_lock:
+        session['running_threads'] += 1
+
+    return session
+
+
+def start_thread_profiler(session):
+    """ Profiles the calling thread for a session it registered with. 'cProfile' only sees the thread it is enabled in. """
+    if not session:
+        return None
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return session, profiler
+
+
+def finish_thread_profiler(thread_profile):
+    if not thread_profile:
+        return
+
+    session, profiler = thread_profile
+    profiler.disable()
+
+    with profile_lock:
+        session['thread_profilers'].append(profiler)
+        session['running_threads'] -= 1
+        # The last thread still running after the session ended writes the report.
+        finish = session['ended'] and not session['running_threads']
+
+    if finish:
+        finish_profile_session(session)
+
+
+def end_profile_session():
+    global profile_session
+
+    session = profile_session
+    profile_session = None
+
+    with profile_lock:
+        session['ended'] = True
+        if session['running_threads']:
+            xbmc.log("Waiting for {0} background thread(s) to finish the profiling session ...".format(session['running_threads']))
+            return
+
+    finish_profile_session(session)
+
+
+def build_top_functions(profilers):
+    stats = pstats.Stats(*profilers).stats
+    # Each entry is (primitive calls, total calls, total time, cumulative time, callers).
+    top_functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP_FUNCTIONS]
+    return [["{0}:{1}({2})".format(os.path.basename(filename), line, function), ncalls, round(tottime, 4), round(cumtime, 4)]
+            for (filename, line, function), (_, ncalls, tottime, cumtime, _) in top_functions]
+
+
+def build_top_allocations(snapshot):
+    top_allocations = []
+    for statistic in snapshot.statistics('lineno')[:PROFILE_TOP_ALLOCATIONS]:
+        frame = statistic.traceback[0]
+        top_allocations.append(["{0}:{1}".format(os.path.basename(frame.filename), frame.lineno), statistic.size / 1024, statistic.count])
+
+    return top_allocations
+
+
+def finish_profile_session(session):
+    global profile_report
+
+    top_allocations = None
+    if tracemalloc:
+        top_allocations = build_top_allocations(tracemalloc.take_snapshot())
+        tracemalloc.stop()
+
+    # Compact report: [location, calls, own time, cumulative time] per function and [location, KB, blocks] per allocation site.
+    profile_report = {"functions": build_top_functions([session['profiler']] + session['thread_profilers']),
+                      "allocations": top_allocations,
+                      "max_rss_kb": [session['start_max_rss_kb'], get_max_rss_kb()]}
+    xbmc.log("Finished profiling session. Report: {0}".format(profile_report))
+
+
+def call_method(method, params, current_display, total_displays):
+    method_function = METHOD_TABLE[method]
+
+    # Background full quality renders profile themselves, see 'FullSliceRenderer.run'.
+    if not profile_session or method == 'profile':
+        return method_function(params, current_display, total_displays)
+
+    profile_session['profiler'].enable()
+    try:
+        return method_function(params, current_display, total_displays)
+    finally:
+        profile_session['profiler'].disable()
+        profile_session['remaining'] -= 1
+        if profile_session['remaining'] <= 0:
+            end_profile_session()
+# End profiling APIs.                                                                                                  #
+########################################################################################################################
+
+
 ########################################################################################################################
 # JSON RPC methods and table.                                                                                          #
 def process_pano(params, current_display, total_displays):
@@ -201,17 +940,54 @@ def display_pano(params, current_display, total_displays):
         return full_pano_path, msg
 
     try:
-        pano_slice_path = full_pano_path_to_pano_slice_path[full_pano_path]
+        pano_slice_path = get_best_pano_slice_path(full_pano_path)
     except KeyError:
         return None, "Could not map full pano path '{0}' to pano slice path. You need to send 'process_pano' command first.".format(full_pano_path)
 
-    apply_display_schedule(params, current_display, full_pano_path)
+    # The second 'display_pano' of a progressive slide is a no-op if the full quality slice is already on screen.
+    if pano_slice_path == slice_store.displayed_path:
+        xbmc.log("Pano slice '{0}' is already displayed.".format(pano_slice_path))
+        return pano_slice_path, ""
+
+    # Animated slices have to start playing at the same time on all displays, so they ignore the display schedule.
+    if pano_slice_path not in animated_pano_slice_paths:
+        apply_display_schedule(params, current_display, full_pano_path)
     xbmc.log("Displaying pano slice {0} of {1} (path = '{2}')".format(current_display, total_displays, pano_slice_path))
     xbmc.executebuiltin("ShowPicture({0})".format(pano_slice_path))
+    slice_store.mark_displayed(pano_slice_path)
 
     return pano_slice_path, ""
 
 
+def finish_pano(params, current_display, total_displays):
+    full_pano_path, msg = get_full_pano_path_from_params(params)
+    if not full_pano_path:
+        return full_pano_path, msg
+
+    # Do not block the receive loop while the full quality slice renders. The client polls until every server of the
+    # wall replies with its full quality slice and then swaps the whole wall to it at once.
+    if full_slice_renderer and full_slice_renderer.is_alive():
+        return FINISH_PANO_PENDING, ""
+
+    finish_full_slice_renderer()
+
+    try:
+        return full_pano_path_to_pano_slice_path[full_pano_path], ""
+    except KeyError:
+        return None, "Could not map full pano path '{0}' to pano slice path. You need to send 'process_pano' command first.".format(full_pano_path)
+
+
+def profile(params, current_display, total_displays):
+    """ Returns the report of the last profiling session and profiles the next 'requests' requests if asked to. """
+    report = profile_report or {}
+
+    nrequests = (params or {}).get('requests', 0)
+    if nrequests > 0:
+        start_profile_session(nrequests)
+
+    return report, ""
+
+
 def turn_off_display(params, current_display, total_displays):
     os.system("vcgencmd display_power 0")
     return None, ""
@@ -232,8 +1008,16 @@ def reboot(params, current_display, total_displays):
     return None, ""
 
 
+# Methods that refer to a pano and need the total number of displays.
+PANO_METHODS = ('process_pano', 'display_pano', 'finish_pano')
+
+# Methods whose result is sent back to the client as a (fragmented) payload.
+PAYLOAD_METHODS = ('profile',)
+
 METHOD_TABLE = {"process_pano": process_pano,
                 "display_pano": display_pano,
+                "finish_pano": finish_pano,
+                "profile": profile,
                 "off": turn_off_display,
                 "on": turn_on_display,
                 "restart": restart,
@@ -244,74 +1028,138 @@ METHOD_TABLE = {"process_pano": process_pano,
 
 ########################################################################################################################
 # Networking APIs.                                                                                                     #
-def send_reply(sock, address, reply, reply_patch=None):
+def send_reply(sock, address, reply, reply_patch=None, binary=False):
     if reply_patch:
         reply.update(reply_patch)
-    xbmc.log("Sending reply {0} to '{1}' ...".format(reply, address))
-    sock.sendto(json.dumps(reply), address)
+    xbmc.log("Sending {0} reply {1} to '{2}' ...".format("binary" if binary else "JSON", reply, address))
+
+    # Reply in the encoding of the request so older clients keep getting JSON.
+    if not binary:
+        sock.sendto(json.dumps(reply), address)
+        return
+
+    # The request ID is only a usable message ID if it is an integer. Anything else still reaches the client in the reply.
+    message_id = reply.get('id') if isinstance(reply.get('id'), (int, long)) else 0
+    for datagram in panodpf_wire.build_datagrams(reply, message_id):
+        sock.sendto(datagram, address)
+
+
+def send_fragmented_reply(sock, address, reply, payload, binary=False):
+    # The binary wire protocol fragments messages of any size on its own.
+    if binary:
+        send_reply(sock, address, reply, {"payload": payload}, binary)
+        return
+
+    # Compress and base64 encode the payload so the fragment size does not depend on JSON escaping.
+    encoded_payload = base64.b64encode(zlib.compress(json.dumps(payload)))
+    fragments = [encoded_payload[i:i + REPLY_FRAGMENT_SIZE] for i in xrange(0, len(encoded_payload), REPLY_FRAGMENT_SIZE)] or [""]
+
+    xbmc.log("Sending reply {0} to '{1}' in {2} fragments ...".format(reply, address, len(fragments)))
+    for fragment_idx, fragment in enumerate(fragments):
+        reply.update({"fragment": fragment_idx, "fragments": len(fragments), "payload": fragment})
+        sock.sendto(json.dumps(reply), address)
 
 
 def process_request_and_send_reply(sock, current_pano_id):
+    global last_profile_request_id
+
     current_display = int(__addon__.getSetting('current_display')) + 1
     total_displays = None
 
     xbmc.log("Waiting to receive message ...")
-    json_request, address = sock.recvfrom(2048)
-    xbmc.log("Received '{0}' from {1}".format(json_request, address))
-    reply = {"jsonrpc": "2.0", "result": "ERROR", "id": None, "current_display": current_display, "total_displays": None}
+    datagram, address = sock.recvfrom(panodpf_wire.WIRE_MAX_DATAGRAM_SIZE)
+    binary = panodpf_wire.is_wire_datagram(datagram)
+    # Advertise the binary wire protocol so clients can switch to it.
+    reply = {"jsonrpc": "2.0", "result": "ERROR", "id": None, "current_display": current_display, "total_displays": None,
+             "wire_versions": [panodpf_wire.WIRE_VERSION]}
 
-    try:
-        request = json.loads(json_request)
-    except TypeError as e:
-        xbmc.log("Could not decode JSON request {0}: {1}".format(json_request, e))
-        send_reply(sock, address, reply, {'error': {"code": -1, "message": "Could not decode JSON request."}})
+    if binary:
+        try:
+            request = wire_reassembler.feed(datagram, address)
+        except (TypeError, ValueError) as e:
+            xbmc.log("Could not decode binary request from {0}: {1}".format(address, e))
+            send_reply(sock, address, reply, {'error': {"code": -1, "message": "Could not decode binary request."}}, binary)
+            return None, current_pano_id
+
+        # Wait for the remaining fragments of the request.
+        if request is None:
+            return None, current_pano_id
+    else:
+        try:
+            request = json.loads(datagram)
+        except (TypeError, ValueError) as e:
+            xbmc.log("Could not decode JSON request {0}: {1}".format(datagram, e))
+            send_reply(sock, address, reply, {'error': {"code": -1, "message": "Could not decode JSON request."}})
+            return None, current_pano_id
+
+    xbmc.log("Received {0} request '{1}' from {2}".format("binary" if binary else "JSON", request, address))
+
+    # Both encodings can carry any value, but only a map is a request.
+    if not isinstance(request, dict):
+        send_reply(sock, address, reply, {'error': {"code": -1, "message": "Request is not an object."}}, binary)
         return None, current_pano_id
 
     reply['id'] = request.get('id')
     method = request.get('method')
     params = request.get('params')
 
-    if method in ('process_pano', 'display_pano'):
+    if method in PANO_METHODS:
         try:
             total_displays = params['total_displays']
-        except KeyError:
+        except (KeyError, TypeError):
             xbmc.log("Request did not specify the total number of displays. ")
-            send_reply(sock, address, reply, {'error': {"code": -5, "message": "Request did not specify the total number of displays."}})
+            send_reply(sock, address, reply, {'error': {"code": -5, "message": "Request did not specify the total number of displays."}}, binary)
             return None, current_pano_id
 
         reply['total_displays'] = total_displays
 
         if request.get('id') == current_pano_id:
-            send_reply(sock, address, reply, {'result': 'Duplicate'})
+            send_reply(sock, address, reply, {'result': 'Duplicate'}, binary)
             return None, current_pano_id
 
         if current_display > total_displays:
             xbmc.log("Current display number {0} is bigger than the total number of displays {1}.".format(current_display, total_displays))
-            send_reply(sock, address, reply, {'error': {"code": -6, "message": "Current display number is bigger than the total number of displays."}})
+            send_reply(sock, address, reply, {'error': {"code": -6, "message": "Current display number is bigger than the total number of displays."}}, binary)
             return None, current_pano_id
 
+    # A retried 'profile' request only gets the report again. Arming a new session would throw away the one in progress.
+    if method == 'profile':
+        if request.get('id') == last_profile_request_id:
+            params = dict(params or {}, requests=0)
+        last_profile_request_id = request.get('id')
+
     try:
-        result, reason = METHOD_TABLE[method](params, current_display, total_displays)
+        result, reason = call_method(method, params, current_display, total_displays)
     except KeyError:
         msg = "Invalid method '{0}'.".format(method)
         xbmc.log(msg)
-        send_reply(sock, address, reply, {'error': {"code": -2, "message": msg}})
+        send_reply(sock, address, reply, {'error': {"code": -2, "message": msg}}, binary)
         return None, current_pano_id
     except Exception as e:
         msg = "Failed to execute method '{0}' with params '{1}': {2}".format(method, params, e)
         xbmc.log(msg)
-        send_reply(sock, address, reply, {'error': {"code": -4, "message": msg}})
+        send_reply(sock, address, reply, {'error': {"code": -4, "message": msg}}, binary)
         return None, current_pano_id
 
-    if method in ('process_pano', 'display_pano'):
+    # Polls for a pending result must not be taken for duplicates, so the request ID is only recorded once it is done.
+    if result == FINISH_PANO_PENDING:
+        send_reply(sock, address, reply, {'result': FINISH_PANO_PENDING}, binary)
+        return None, current_pano_id
+
+    if method in PANO_METHODS:
         current_pano_id = request.get('id')
 
-    if not result and method in ('process_pano', 'display_pano'):
+    if not result and method in PANO_METHODS:
         reply['error'] = {'code': -3, 'message': reason}
     else:
         reply['result'] = 'OK'
 
-    send_reply(sock, address, reply)
+    if method in PAYLOAD_METHODS:
+        send_fragmented_reply(sock, address, reply, result, binary)
+        # The payload is not a pano slice path.
+        return None, current_pano_id
+
+    send_reply(sock, address, reply, binary=binary)
 
     return result, current_pano_id
 # End networking APIs.                                                                                                 #
@@ -319,6 +1167,8 @@ def process_request_and_send_reply(sock, current_pano_id):
 
 
 def start_panodpf_server():
+    global slice_store
+
     # Instantiate a monitor object so we can check if we need to exit.
     monitor = xbmc.Monitor()
 
@@ -334,6 +1184,9 @@ def start_panodpf_server():
     xbmc.log("Started multicast Pano DPF UDP server on multicast address {0} and port {1} ...".format(multicast_address, multicast_port))
     xbmc.log("Addon WD: {0}".format(__cwd__))
 
+    # Create the slice store. This also reclaims slices orphaned by a previous server loop.
+    slice_store = create_slice_store()
+
     # Tell the operating system to add the socket to the multicast group on all interfaces.
     group = socket.inet_aton(multicast_address)
     mreq = struct.pack('4sL', group, socket.INADDR_ANY)